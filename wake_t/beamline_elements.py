@@ -2,23 +2,138 @@
 # TODO: unify classes of plasma elements to avoid code repetition (specially in
 # tracking)
 import time
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from copy import copy
 
 import numpy as np
 import scipy.constants as ct
+from numba import config, get_num_threads, set_num_threads
 import aptools.plasma_accel.general_equations as ge
 
-from wake_t.particle_tracking import (runge_kutta_4, track_with_transfer_map)
+from wake_t.particle_tracking import (runge_kutta_4, analytic_step,
+                                      gamma_from_momentum,
+                                      weighted_mean_gamma, weighted_means,
+                                      track_with_transfer_map)
 from wake_t.wakefields import *
 from wake_t.driver_witness import ParticleBunch
-from wake_t.utilities.other import print_progress_bar
+from wake_t.utilities.other import (print_progress_bar,
+                                    matched_plasma_beta_function)
 from wake_t.utilities.bunch_manipulation import (convert_to_ocelot_matrix,
                                                  convert_from_ocelot_matrix,
                                                  rotation_matrix_xz)
 
 
+def _get_chunk_slices(n_part, n_chunks):
+    """ Get the slices which split n_part particles into n_chunks chunks """
+    edges = np.linspace(0, n_part, n_chunks+1).astype(int)
+    return [slice(i_0, i_1) for i_0, i_1 in zip(edges[:-1], edges[1:])]
+
+
+def _track_chunk(slc, WF, coords, q, t0, dt, iterations):
+    """ Track the particles in a slice of the phase-space buffers in place """
+    new_coords = runge_kutta_4(*[u[slc] for u in coords], q[slc], WF=WF,
+                               t0=t0, dt=dt, iterations=iterations,
+                               dtype=coords[0].dtype)
+    for u, u_new in zip(coords, new_coords):
+        np.copyto(u[slc], u_new)
+
+
+def _track_phase_space(WF, coords, q, t_step, dt, it_per_step, steps,
+                       parallel, n_proc, snapshot_every, auto_update=False):
+    """
+    Track the phase space 'coords' = (x, px, y, py, xi, pz) in place through
+    the field WF in 'steps' steps of duration 't_step', each one made of
+    'it_per_step' RK4 iterations of duration 'dt'. Fields with a Numba kernel
+    are tracked with it, the rest with the generic RK4 solver (in threads, if
+    parallel=True). If 'auto_update', the fields are updated (if needed) at
+    the beginning of each step.
+
+    The threads only run concurrently inside the Numba kernels called by the
+    solver, which are therefore compiled with nogil=True. Each thread uses
+    its own shallow copy of the wakefield, so fields which keep state (e.g.
+    solver buffers) must give their copies independent state in __copy__.
+
+    Returns a list with the time and a copy of the phase space at every
+    'snapshot_every' steps and at the last one.
+    """
+    if not isinstance(snapshot_every, (int, np.integer)) or snapshot_every < 1:
+        raise ValueError(
+            "snapshot_every must be an integer >= 1, got {}.".format(
+                snapshot_every))
+    if n_proc is None:
+        n_proc = cpu_count()
+    wf_kernel = WF.get_kernel()
+    thread_pool = None
+    # the number of Numba threads is global, restore it afterwards
+    prev_num_threads = get_num_threads()
+    if wf_kernel is not None:
+        # compute with the Numba kernel specialized for this field
+        rk4_kernel, wf_params = wf_kernel
+        if parallel:
+            num_threads = min(n_proc, config.NUMBA_NUM_THREADS)
+            print('Parallel computation in {} threads.'.format(num_threads))
+        else:
+            num_threads = 1
+            print('Serial computation.')
+        set_num_threads(num_threads)
+    elif parallel:
+        # each thread tracks one slice of the phase-space buffers with its
+        # own copy of the wakefield
+        print('Parallel computation in {} threads.'.format(n_proc))
+        slices = _get_chunk_slices(len(coords[0]), n_proc)
+        wf_list = [copy(WF) for _ in slices]
+        thread_pool = ThreadPoolExecutor(n_proc)
+        map_chunks = thread_pool.map
+    else:
+        print('Serial computation.')
+        slices = [slice(None)]
+        wf_list = [WF]
+        map_chunks = map
+    snapshots = list()
+    try:
+        print('')
+        st_0 = "Tracking in {} step(s)... ".format(steps)
+        for s in np.arange(steps):
+            print_progress_bar(st_0, s, steps-1)
+            t_0 = s*t_step
+            if wf_kernel is not None:
+                rk4_kernel(*coords, t_0, dt, it_per_step, wf_params)
+            else:
+                if (auto_update and WF.check_if_update_fields(t_0)
+                        and thread_pool is not None):
+                    wf_list = [copy(WF) for _ in slices]
+                chunk_solver = partial(
+                    _track_chunk, coords=coords, q=q, t0=t_0, dt=dt,
+                    iterations=it_per_step)
+                list(map_chunks(chunk_solver, slices, wf_list))
+            if (s+1) % snapshot_every == 0 or s == steps-1:
+                snapshots.append(((s+1)*t_step, np.array(coords)))
+    finally:
+        set_num_threads(prev_num_threads)
+        if thread_pool is not None:
+            thread_pool.shutdown()
+    return snapshots
+
+
+def _get_tracked_beams(beam, snapshots, length):
+    """
+    Create the bunches from the snapshots of '_track_phase_space' and update
+    'beam' to the last one after propagating through 'length'.
+    """
+    beam_list = [
+        ParticleBunch(beam.q, bunch_matrix=phase_space,
+                      prop_distance=beam.prop_distance + t*ct.c,
+                      dtype=beam.dtype)
+        for t, phase_space in snapshots]
+    last_beam = beam_list[-1]
+    beam.set_phase_space(last_beam.x, last_beam.y, last_beam.xi,
+                         last_beam.px, last_beam.py, last_beam.pz)
+    beam.increase_prop_distance(length)
+    return beam_list
+
+
 class PlasmaStage():
 
     """ Defines a plasma stage. """
@@ -66,21 +181,18 @@ class PlasmaStage():
 
         """
         if mode == "Blowout":
-            return ge.matched_plasma_beta_function(ene, n_p=self.n_p*1e-6,
-                                                   regime='Blowout')
+            return matched_plasma_beta_function(ene, n_p=self.n_p*1e-6,
+                                                regime='Blowout')
 
         elif mode in ["CustomBlowout", "FromGivenFields"]:
-            return ge.matched_plasma_beta_function(ene, k_x=foc_strength)
+            return matched_plasma_beta_function(ene, k_x=foc_strength)
 
         elif mode == "Linear":
             dist_l_b = -(laser.get_lon_center()-xi)
-            return ge.matched_plasma_beta_function(
+            return matched_plasma_beta_function(
                 ene, n_p=self.n_p*1e-6, regime='Blowout',
                 dist_from_driver=dist_l_b, a_0=laser.a_0, w_0=laser.w_0)
 
-    def _gamma(self, px, py, pz):
-        return np.sqrt(1 + px**2 + py**2 + pz**2)
-    
     def track_beam_numerically(
             self, laser, beam, mode, steps, simulation_code=None,
             simulation_path=None, time_step=None, auto_update_fields=False,
@@ -88,7 +200,8 @@ class PlasmaStage():
             lon_field_slope=None, foc_strength=None, field_offset=0,
             filter_fields=False, filter_sigma=20, laser_evolution=False,
             laser_z_foc=0, r_max=None, xi_min=None, xi_max=None, n_r=100, 
-            n_xi=100, parallel=False, n_proc=None):
+            n_xi=100, parallel=False, n_proc=None, snapshot_every=1,
+            use_cuda=False, field_dtype=np.float32):
         """
         Track the beam through the plasma using a 4th order Runge-Kutta method.
         
@@ -199,12 +312,24 @@ class PlasmaStage():
             Determines whether or not to use parallel computation.
 
         n_proc : int
-            Number of processes to run in parallel. If None, this will equal
-            the number of physical cores.
+            Number of threads to run in parallel. If None, this will equal
+            the number of CPU cores.
+
+        snapshot_every : int
+            Store the beam distribution only every 'snapshot_every' steps.
+            The distribution at the last step is always stored.
+
+        use_cuda : bool
+            Whether to calculate the wakefields on a CUDA GPU (if available).
+            Used only if mode='cold_fluid_1d'.
+
+        field_dtype : data-type
+            Floating point type in which the fields read from the PIC
+            simulation are stored. Only used if mode='FromPICCode'.
 
         Returns:
         --------
-        A list of size 'steps' containing the beam distribution at each step.
+        A list containing the beam distribution at each stored step.
 
         """
         print('')
@@ -212,7 +337,7 @@ class PlasmaStage():
         print('-'*len('Plasma stage'))
         if mode == "Blowout":
             WF = BlowoutWakefield(self.n_p, laser)
-        if mode == "CustomBlowout":
+        elif mode == "CustomBlowout":
             WF = CustomBlowoutWakefield(
                 self.n_p, laser, np.average(beam.xi, weights=beam.q), 
                 lon_field, lon_field_slope, foc_strength, field_offset)
@@ -220,15 +345,17 @@ class PlasmaStage():
             if vpic_installed:
                 WF = WakefieldFromPICSimulation(
                     simulation_code, simulation_path, laser, time_step,
-                    self.n_p, filter_fields, filter_sigma, reverse_tracking)
+                    self.n_p, filter_fields, filter_sigma, reverse_tracking,
+                    field_dtype)
             else:
                 return []
         elif mode == 'cold_fluid_1d':
             WF = NonLinearColdFluidWakefield(self.calculate_density, laser,
                                              laser_evolution, laser_z_foc,
-                                             r_max, xi_min, xi_max, n_r, n_xi)
-        # Get 6D matrix
-        mat = beam.get_6D_matrix_with_charge()
+                                             r_max, xi_min, xi_max, n_r, n_xi,
+                                             use_cuda)
+        # Get 6D phase space (copied, since it is updated during tracking)
+        coords = np.copy(beam.get_6D_matrix())
         # Plasma length in time
         t_final = self.length/ct.c
         t_step = t_final/steps
@@ -238,80 +365,22 @@ class PlasmaStage():
         it_per_step = max(int(iterations/steps), 1)
         iterations = it_per_step*steps
         dt_adjusted = t_final/iterations
-        # initialize list to store the distribution at each step
-        beam_list = list()
         # get start time
         start = time.time()
-        if parallel:
-            # compute in parallel
-            if n_proc is None:
-                num_proc = cpu_count()
-            else:
-                num_proc = n_proc
-            print('Parallel computation in {} processes.'.format(num_proc))
-            num_part = mat.shape[1]
-            part_per_proc = int(np.ceil(num_part/num_proc))
-            process_pool = Pool(num_proc)
-            t_s = 0
-            matrix_list = list()
-            # start computaton
-            try:
-                for p in np.arange(num_proc):
-                    matrix_list.append(
-                        mat[:,p*part_per_proc:(p+1)*part_per_proc])
-                
-                print('')
-                st_0 = "Tracking in {} step(s)... ".format(steps)
-                for s in np.arange(steps):
-                    print_progress_bar(st_0, s, steps-1)
-                    if auto_update_fields:
-                        WF.check_if_update_fields(s*t_step)
-                    partial_solver = partial(
-                        runge_kutta_4, WF=WF, dt=dt_adjusted,
-                        iterations=it_per_step, t0=s*t_step)
-                    matrix_list = process_pool.map(partial_solver, matrix_list)
-                    beam_matrix = np.concatenate(matrix_list, axis=1)
-                    x, px, y, py, xi, pz, q = beam_matrix
-                    new_prop_dist = beam.prop_distance + (s+1)*t_step*ct.c
-                    beam_list.append(
-                        ParticleBunch(beam.q, x, y, xi, px, py, pz,
-                                      prop_distance=new_prop_dist)
-                        )
-            finally:
-                process_pool.close()
-                process_pool.join()
-        else:
-            # compute in single process
-            print('Serial computation.')
-            print('')
-            st_0 = "Tracking in {} step(s)... ".format(steps)
-            for s in np.arange(steps):
-                print_progress_bar(st_0, s, steps-1)
-                beam_matrix = runge_kutta_4(mat, WF=WF, t0=s*t_step,
-                                            dt=dt_adjusted,
-                                            iterations=it_per_step)
-                x, px, y, py, xi, pz, q = copy(beam_matrix)
-                new_prop_dist = beam.prop_distance + (s+1)*t_step*ct.c
-                beam_list.append(
-                    ParticleBunch(beam.q, x, y, xi, px, py, pz,
-                                    prop_distance=new_prop_dist)
-                    )
+        snapshots = _track_phase_space(
+            WF, coords, beam.q, t_step, dt_adjusted, it_per_step, steps,
+            parallel, n_proc, snapshot_every, auto_update_fields)
         # print computing time
         end = time.time()
         print("Done ({:1.3f} seconds).".format(end-start))
         print('-'*80)
-        # update beam data
-        last_beam = beam_list[-1]
-        beam.set_phase_space(last_beam.x, last_beam.y, last_beam.xi,
-                             last_beam.px, last_beam.py, last_beam.pz)
-        beam.increase_prop_distance(self.length)
-        return beam_list
+        # create the output bunches and update beam data
+        return _get_tracked_beams(beam, snapshots, self.length)
     
     def _get_optimized_dt(self, beam, WF):
         """ Get optimized time step """ 
-        gamma = self._gamma(beam.px, beam.py, beam.pz)
         k_x = ge.plasma_focusing_gradient_blowout(self.n_p*1e-6)
-        mean_gamma = np.average(gamma, weights=beam.q)
+        mean_gamma = weighted_mean_gamma(beam.px, beam.py, beam.pz, beam.q)
         w_x = np.sqrt(ct.e*ct.c/ct.m_e * k_x/mean_gamma)
         T_x = 1/w_x
         dt = 0.1*T_x
@@ -390,12 +459,11 @@ class PlasmaStage():
         w_0_l = laser.w_0
 
         # Main beam quantities [SI units]
-        x_0 = beam.x
-        y_0 = beam.y
-        xi_0 = beam.xi
-        px_0 = beam.px * ct.m_e * ct.c
-        py_0 = beam.py * ct.m_e * ct.c
-        pz_0 = beam.pz * ct.m_e * ct.c
+        # always in double precision, some quantities overflow in float32
+        x_0, u_x_0, y_0, u_y_0, xi_0, u_z_0 = beam.get_6D_matrix().astype(
+            np.float64)
+        px_0 = u_x_0 * ct.m_e * ct.c
+        py_0 = u_y_0 * ct.m_e * ct.c
 
         # Distance between laser and beam particle
         dist_l_b = -(l_c-xi_0)
@@ -403,40 +471,51 @@ class PlasmaStage():
         # Plasma length in time
         t_final = self.length/ct.c
 
+        # Factors to convert fields in SI units into the normalized
+        # accelerating (E = inv_mec*E_z) and focusing (K = foc_conv*g_x)
+        # strengths of the model.
+        inv_mec = -ct.e/(ct.m_e*ct.c)
+        foc_conv = ct.c*ct.e/ct.m_e
+
         # Fields
         if mode == "Blowout":
             """Bubble center is assumed at lambda/2"""
-            w_p = np.sqrt(self.n_p*ct.e**2/(ct.m_e*ct.epsilon_0))
-            l_p = 2*np.pi*ct.c/w_p
-            E_p = -w_p**2/(2*ct.c) * np.ones_like(xi_0)
-            K = w_p**2/2 * np.ones_like(xi_0)
+            w_p_sq = self.n_p*ct.e**2/(ct.m_e*ct.epsilon_0)
+            l_p = 2*np.pi*ct.c/np.sqrt(w_p_sq)
+            E_p = -w_p_sq/(2*ct.c) * np.ones_like(xi_0)
+            K = w_p_sq/2 * np.ones_like(xi_0)
             E = E_p*(l_p/2+dist_l_b)
 
         elif mode == "CustomBlowout":
-            E_p = -lon_field_slope*ct.e/(ct.m_e*ct.c) * np.ones_like(xi_0)
-            K = foc_strength*ct.c*ct.e/ct.m_e * np.ones_like(xi_0)
-            E = -lon_field*ct.e/(ct.m_e*ct.c) + E_p*(xi_0 - np.mean(xi_0))
+            E_p = lon_field_slope*inv_mec * np.ones_like(xi_0)
+            K = foc_strength*foc_conv * np.ones_like(xi_0)
+            E = lon_field*inv_mec + E_p*(xi_0 - np.mean(xi_0))
 
         elif mode == "Linear":
             a0 = laser.a_0
-            w_p = np.sqrt(n_p*ct.e**2/(ct.m_e*ct.epsilon_0))
+            w_p = np.sqrt(self.n_p*ct.e**2/(ct.m_e*ct.epsilon_0))
             k_p = w_p/ct.c
             E0 = ct.m_e*ct.c*w_p/ct.e
             K = (8*np.pi/np.e)**(1/4)*a0/(k_p*w_0_l)
-
             A = E0*np.sqrt(np.pi/(2*np.e))*a0**2
-            E_z = A*np.cos(k_p*(dist_l_b))
-            E_z_p = -A*k_p*np.sin(k_p*(dist_l_b))
-            g_x = -E0*K**2*k_p*np.sin(k_p*dist_l_b)/ct.c
-            g_x_slope = -E0*K**2*k_p**2*np.cos(k_p*dist_l_b)/ct.c
+            g_x_amp = -E0*K**2*k_p/ct.c
+
+            # evaluate cos and sin of the wake phase only once
+            phase = k_p*dist_l_b
+            cos_phase = np.cos(phase)
+            sin_phase = np.sin(phase)
+            E_z = A*cos_phase
+            E_z_p = -A*k_p*sin_phase
+            g_x = g_x_amp*sin_phase
+            g_x_slope = g_x_amp*k_p*cos_phase
 
-            E = -ct.e/(ct.m_e*ct.c)*E_z
-            E_p = -ct.e/(ct.m_e*ct.c)*E_z_p
-            K = g_x*ct.c*ct.e/ct.m_e
+            E = inv_mec*E_z
+            E_p = inv_mec*E_z_p
+            K = g_x*foc_conv
 
         elif mode == "Linear2":
             a0 = laser.a_0
-            w_p = np.sqrt(n_p*ct.e**2/(ct.m_e*ct.epsilon_0))
+            w_p = np.sqrt(self.n_p*ct.e**2/(ct.m_e*ct.epsilon_0))
             k_p = w_p/ct.c
             E0 = ct.m_e*ct.c*w_p/ct.e
 
@@ -445,15 +524,20 @@ class PlasmaStage():
             sz = L/np.sqrt(2)
             sx = w_0_l/2
 
-            A = E0 * nb0 * np.sqrt(2*np.pi) * sz * np.exp(-(sz)**2/2)
-            E_z =  A*np.cos(k_p*dist_l_b)
-            E_z_p = -A*k_p*np.sin(k_p*(dist_l_b)) # [V/m^2]
-            g_x = -(nb0 * np.sqrt(2*np.pi) * sz * np.exp(-(sz)**2/2)
-                    * ( 1/ (k_p*sx)**2) * np.sin(k_p*(dist_l_b)) * k_p*E0/ct.c)
+            pref = nb0 * np.sqrt(2*np.pi) * sz * np.exp(-(sz)**2/2)
+            A = E0 * pref
+            g_x_amp = -pref * (1/ (k_p*sx)**2) * k_p*E0/ct.c
+
+            # evaluate cos and sin of the wake phase only once
+            phase = k_p*dist_l_b
+            sin_phase = np.sin(phase)
+            E_z =  A*np.cos(phase)
+            E_z_p = -A*k_p*sin_phase # [V/m^2]
+            g_x = g_x_amp*sin_phase
 
-            E = -ct.e/(ct.m_e*ct.c)*E_z
-            E_p = -ct.e/(ct.m_e*ct.c)*E_z_p
-            K = g_x*ct.c*ct.e/ct.m_e
+            E = inv_mec*E_z
+            E_p = inv_mec*E_z_p
+            K = g_x*foc_conv
 
         elif mode == "FromOsiris2D":
             raise NotImplementedError()
@@ -475,8 +559,8 @@ class PlasmaStage():
         
 
         # Some initial values
-        p_0 = np.sqrt(np.square(px_0) + np.square(py_0) + np.square(pz_0))
-        g_0 = np.sqrt(np.square(p_0)/(ct.m_e*ct.c)**2 + 1)
+        u_0 = np.array([u_x_0, u_y_0, u_z_0])
+        g_0 = np.sqrt(np.einsum('ij,ij->j', u_0, u_0) + 1)
         w_0 = np.sqrt(K/g_0)
 
         # Initial velocities
@@ -500,13 +584,24 @@ class PlasmaStage():
         # track beam in steps
         #print("Tracking plasma stage in {} steps...   ".format(steps))
         start = time.time()
-        p = Pool(cpu_count())
         t = t_final/steps*(np.arange(steps)+1)
-        part = partial(self._get_beam_at_specified_time_step_analytically,
-                       beam=beam, g_0=g_0, w_0=w_0, xi_0=xi_0, A_x=A_x,
-                       A_y=A_y, phi_x_0=phi_x_0, phi_y_0=phi_y_0, E=E, E_p=E_p,
-                       v_w=v_w, K=K)
-        beam_steps_list = p.map(part, t)
+        n_part = len(xi_0)
+        beam_steps_list = list()
+        for t_s in t:
+            phase_space = np.empty((6, n_part), dtype=beam.dtype)
+            x, p_x, y, p_y, xi, p_z = phase_space
+            n_unphysical = analytic_step(
+                t_s, g_0, w_0, xi_0, A_x, A_y, phi_x_0, phi_y_0, E, E_p, v_w,
+                K, x, p_x, y, p_y, xi, p_z)
+            if n_unphysical > 0:
+                print('Warning: unphysical energy found in {} '.format(
+                      n_unphysical) + 'particles due to negative accelerating '
+                      + 'gradient.')
+            beam_steps_list.append(
+                ParticleBunch(beam.q, bunch_matrix=phase_space,
+                              prop_distance=beam.prop_distance+t_s*ct.c,
+                              dtype=beam.dtype)
+                )
         end = time.time()
         print("Done ({} seconds)".format(end-start))
 
@@ -523,48 +618,6 @@ class PlasmaStage():
         # return steps
         return beam_steps_list
 
-    def _get_beam_at_specified_time_step_analytically(
-        self, t, beam, g_0, w_0, xi_0, A_x, A_y, phi_x_0, phi_y_0, E, E_p, v_w,
-        K):
-        G = 1 + E/g_0*t
-        if (G < 1/g_0).any():
-            n_part = len(np.where(G<1/g_0)[0])
-            print('Warning: unphysical energy found in {}'.format(n_part) 
-                  + 'particles due to negative accelerating gradient.')
-            # fix unphysical energies (model does not work well when E<=0)
-            G = np.where(G<1/g_0, 1/g_0, G)
-
-        phi = 2*np.sqrt(K*g_0)/E*(G**(1/2) - 1)
-        if (E == 0).any():
-            # apply limit when E->0
-            idx_0 = np.where(E==0)[0]
-            phi[idx_0] =  np.sqrt(K[idx_0]/g_0[idx_0])*t[idx_0]
-        A_0 = np.sqrt(A_x**2 + A_y**2)
-
-        x = A_x*G**(-1/4)*np.cos(phi + phi_x_0)
-        v_x = -w_0*A_x*G**(-3/4)*np.sin(phi + phi_x_0)
-        p_x = G*g_0*v_x/ct.c
-
-        y = A_y*G**(-1/4)*np.cos(phi + phi_y_0)
-        v_y = -w_0*A_y*G**(-3/4)*np.sin(phi + phi_y_0)
-        p_y = G*g_0*v_y/ct.c
-
-        delta_xi = (ct.c/(2*E*g_0)*(G**(-1)- 1)
-                    + A_0**2*K/(2*ct.c*E)*(G**(-1/2) - 1))
-        xi = xi_0 + delta_xi
-
-        delta_xi_max = -1/(2*E)*(ct.c/g_0 + A_0**2*K/ct.c)
-        
-        g = (g_0 + E*t + E_p*delta_xi_max*t + E_p/2*(ct.c-v_w)*t**2
-             + ct.c*E_p/(2*E**2)*np.log(G)
-             + E_p*A_0**2*K*g_0/(ct.c*E**2)*(G**(1/2) - 1))
-        p_z = np.sqrt(g**2-p_x**2-p_y**2)
-
-        beam_step = ParticleBunch(beam.q, x, y, xi, p_x, p_y, p_z,
-                                  prop_distance=beam.prop_distance+t*ct.c)
-
-        return beam_step
-
 
 class PlasmaRamp():
 
@@ -611,11 +664,15 @@ class PlasmaRamp():
         self.plasma_dens_top = plasma_dens_top
         self.ramp_type = ramp_type
         self.profile = profile
+        # ramp parameters and maximum focusing gradient of last evaluation
+        self._max_kx_cache = None
         
     def track_beam_numerically(self, beam, steps, mode='blowout', laser=None,
                                laser_evolution=False, laser_z_foc=0, 
                                r_max=None, xi_min=None, xi_max=None, n_r=100,
-                               n_xi=100, parallel=False, n_proc=None):
+                               n_xi=100, parallel=False, n_proc=None,
+                               snapshot_every=1, use_cuda=False,
+                               density_samples=None):
         """
         Track the beam through the plasma using a 4th order Runge-Kutta method.
         
@@ -672,19 +729,38 @@ class PlasmaRamp():
             Determines whether or not to use parallel computation.
 
         n_proc : int
-            Number of processes to run in parallel. If None, this will equal
-            the number of physical cores. Required only if parallel=True.
+            Number of threads to run in parallel. If None, this will equal
+            the number of CPU cores. Required only if parallel=True.
+
+        snapshot_every : int
+            Store the beam distribution only every 'snapshot_every' steps.
+            The distribution at the last step is always stored.
+
+        use_cuda : bool
+            Whether to calculate the wakefields on a CUDA GPU (if available).
+            Used only if mode='cold_fluid_1d'.
+
+        density_samples : int
+            If given, the plasma density is sampled at this number of points
+            along the ramp and linearly interpolated at the position of each
+            particle, instead of being evaluated for every particle. Used
+            only if mode='blowout'.
 
         Returns:
         --------
-        A list of size 'steps' containing the beam distribution at each step.
+        A list containing the beam distribution at each stored step.
 
         """
         print('')
         print('Plasma ramp')
         print('-'*len('Plasma ramp'))
         if mode == 'blowout':
-            field = PlasmaRampBlowoutField(self.calculate_density)
+            if density_samples is not None:
+                z_range = (np.min(beam.xi), self.length + np.max(beam.xi))
+                field = PlasmaRampBlowoutField(
+                    self.calculate_density, z_range, density_samples)
+            else:
+                field = PlasmaRampBlowoutField(self.calculate_density)
         elif mode == 'blowout_non_rel':
             raise NotImplementedError()
         elif mode == 'cold_fluid_1d':
@@ -693,9 +769,9 @@ class PlasmaRamp():
             field = NonLinearColdFluidWakefield(self.calculate_density,
                                                 laser, laser_evolution,
                                                 laser_z_foc, r_max, xi_min,
-                                                xi_max, n_r, n_xi)
-        # Main beam quantities
-        mat = beam.get_6D_matrix_with_charge()
+                                                xi_max, n_r, n_xi, use_cuda)
+        # Main beam quantities (copied, since they are updated during tracking)
+        coords = np.copy(beam.get_6D_matrix())
         # Plasma length in time
         t_final = self.length/ct.c
         t_step = t_final/steps
@@ -705,84 +781,42 @@ class PlasmaRamp():
         it_per_step = max(int(iterations/steps), 1)
         iterations = it_per_step*steps
         dt_adjusted = t_final/iterations
-        beam_list = list()
 
         start = time.time()
-
-        if parallel:
-            if n_proc is None:
-                num_proc = cpu_count()
-            else:
-                num_proc = n_proc
-            print('Parallel computation in {} processes.'.format(num_proc))
-            num_part = mat.shape[1]
-            part_per_proc = int(np.ceil(num_part/num_proc))
-            process_pool = Pool(num_proc)
-            t_s = 0
-            matrix_list = list()
-            try:
-                for p in np.arange(num_proc):
-                    matrix_list.append(
-                        mat[:,p*part_per_proc:(p+1)*part_per_proc])
-                print('')
-                st_0 = "Tracking in {} step(s)... ".format(steps)
-                for s in np.arange(steps):
-                    print_progress_bar(st_0, s, steps-1)
-                    partial_solver = partial(
-                        runge_kutta_4, WF=field, dt=dt_adjusted,
-                        iterations=it_per_step, t0=s*t_step)
-                    matrix_list = process_pool.map(partial_solver, matrix_list)
-                    beam_matrix = np.concatenate(matrix_list, axis=1)
-                    x, px, y, py, xi, pz, q = beam_matrix
-                    new_prop_dist = beam.prop_distance + (s+1)*t_step*ct.c
-                    beam_list.append(
-                        ParticleBunch(beam.q, x, y, xi, px, py, pz,
-                                      prop_distance=new_prop_dist)
-                        )
-            finally:
-                process_pool.close()
-                process_pool.join()
-        else:
-            print('Serial computation.')
-            print('')
-            st_0 = "Tracking in {} step(s)... ".format(steps)
-            for s in np.arange(steps):
-                print_progress_bar(st_0, s, steps-1)
-                beam_matrix = runge_kutta_4(mat, WF=field, t0=s*t_step,
-                                            dt=dt_adjusted,
-                                            iterations=it_per_step)
-                x, px, y, py, xi, pz, q = copy(beam_matrix)
-                new_prop_dist = beam.prop_distance + (s+1)*t_step*ct.c
-                beam_list.append(
-                    ParticleBunch(beam.q, x, y, xi, px, py, pz,
-                                    prop_distance=new_prop_dist)
-                    )
+        snapshots = _track_phase_space(
+            field, coords, beam.q, t_step, dt_adjusted, it_per_step, steps,
+            parallel, n_proc, snapshot_every)
         end = time.time()
         print("Done ({:1.3f} seconds).".format(end-start))
         print('-'*80)
-        # update beam data
-        last_beam = beam_list[-1]
-        beam.set_phase_space(last_beam.x, last_beam.y, last_beam.xi,
-                             last_beam.px, last_beam.py, last_beam.pz)
-        beam.increase_prop_distance(self.length)
-
-        return beam_list
+        # create the output bunches and update beam data
+        return _get_tracked_beams(beam, snapshots, self.length)
     
     def _get_optimized_dt(self, beam, wakefield):
-        gamma = self._gamma(beam.px, beam.py, beam.pz)
-        mean_gamma = np.average(gamma, weights=beam.q)
-        # calculate maximum focusing on ramp.
-        z = np.linspace(0, self.length, 100)
-        n_p = self.calculate_density(z)
-        w_p = np.sqrt(max(n_p)*ct.e**2/(ct.m_e*ct.epsilon_0))
-        max_kx = (ct.m_e/(2*ct.e*ct.c))*w_p**2
+        mean_gamma = weighted_mean_gamma(beam.px, beam.py, beam.pz, beam.q)
+        max_kx = self._get_max_focusing()
         w_x = np.sqrt(ct.e*ct.c/ct.m_e * max_kx/mean_gamma)
         period_x = 1/w_x
         dt = 0.1*period_x
         return dt
 
-    def _gamma(self, px, py, pz):
-        return np.sqrt(1 + px**2 + py**2 + pz**2)
+    def _get_max_focusing(self):
+        """
+        Get the maximum focusing gradient along the ramp. The result is
+        cached and only recalculated if the ramp parameters change.
+        """
+        ramp_params = (self.length, self.plasma_dens_top,
+                       self.plasma_dens_down, self.position_down,
+                       self.ramp_type, self.profile)
+        if (self._max_kx_cache is None
+                or self._max_kx_cache[0] != ramp_params):
+            # calculate maximum focusing on ramp.
+            z = np.linspace(0, self.length, 100)
+            n_p = self.calculate_density(z)
+            w_p = np.sqrt(max(n_p)*ct.e**2/(ct.m_e*ct.epsilon_0))
+            max_kx = (ct.m_e/(2*ct.e*ct.c))*w_p**2
+            self._max_kx_cache = (ramp_params, max_kx)
+        return self._max_kx_cache[1]
 
     def calculate_density(self, z):
         if self.ramp_type == 'upramp':
@@ -833,7 +867,8 @@ class Drift():
             (x, y, xi, px, py, pz) = self._track_step(bunch, l)
             new_prop_dist = bunch.prop_distance + l
             new_bunch = ParticleBunch(bunch.q, x, y, xi, px, py, pz,
-                                      prop_distance=new_prop_dist)
+                                      prop_distance=new_prop_dist,
+                                      dtype=bunch.dtype)
             new_bunch.x_ref = bunch.x_ref + l*np.sin(bunch.theta_ref)
             new_bunch.theta_ref = bunch.theta_ref
             bunch_list.append(new_bunch)
@@ -917,7 +952,7 @@ class TMElement():
         return bunch_list
 
     def get_aligned_beam_matrix_for_tracking(self, bunch):
-        bunch_mat = bunch.get_6D_matrix()
+        bunch_mat = bunch.get_6D_matrix().copy()
         # obtain with respect to reference displacement
         bunch_mat[0] -= bunch.x_ref
         # rotate by the reference angle so that it entern normal to the element
@@ -951,7 +986,8 @@ class TMElement():
         new_bunch_mat[0] += new_x_ref
         # create new bunch
         new_bunch = ParticleBunch(q, bunch_matrix=new_bunch_mat,
-                                  prop_distance=new_prop_dist)
+                                  prop_distance=new_prop_dist,
+                                  dtype=old_bunch.dtype)
         new_bunch.theta_ref = new_theta_ref
         new_bunch.x_ref = new_x_ref
         return new_bunch
@@ -1003,10 +1039,10 @@ class PlasmaLens(object):
         self.foc_strength = foc_strength
 
     def get_matched_beta(self, ene):
-        return ge.matched_plasma_beta_function(ene, k_x=self.foc_strength)
+        return matched_plasma_beta_function(ene, k_x=self.foc_strength)
 
     def track_beam_numerically(self, beam, steps, non_rel=False,
-                               parallel=False, n_proc=None):
+                               parallel=False, n_proc=None, snapshot_every=1):
         """Tracks the beam through the plasma lens and returns the final
         phase space"""
         print('')
@@ -1016,8 +1052,8 @@ class PlasmaLens(object):
             field = PlasmaLensField(self.foc_strength)
         else:
             field = PlasmaLensFieldRelativistic(self.foc_strength)
-        # Main beam quantities
-        mat = beam.get_6D_matrix_with_charge()
+        # Main beam quantities (copied, since they are updated during tracking)
+        coords = np.copy(beam.get_6D_matrix())
 
         # Plasma length in time
         t_final = self.length/ct.c
@@ -1028,75 +1064,26 @@ class PlasmaLens(object):
         it_per_step = max(int(iterations/steps), 1)
         iterations = it_per_step*steps
         dt_adjusted = t_final/iterations
-        beam_list = list()
         start = time.time()
-        if parallel:
-            if n_proc is None:
-                num_proc = cpu_count()
-            else:
-                num_proc = n_proc
-            print('Parallel computation in {} processes.'.format(num_proc))
-            num_part = mat.shape[1]
-            part_per_proc = int(np.ceil(num_part/num_proc))
-            process_pool = Pool(num_proc)
-            t_s = 0
-            matrix_list = list()
-            try:
-                for p in np.arange(num_proc):
-                    matrix_list.append(mat[:,p*part_per_proc:(p+1)*part_per_proc])
-                print('')
-                st_0 = "Tracking in {} step(s)... ".format(steps)
-                for s in np.arange(steps):
-                    print_progress_bar(st_0, s, steps-1)
-                    partial_solver = partial(
-                        runge_kutta_4, WF=field, dt=dt_adjusted,
-                        iterations=it_per_step, t0=s*t_step)
-                    matrix_list = process_pool.map(partial_solver, matrix_list)
-                    beam_matrix = np.concatenate(matrix_list, axis=1)
-                    x, px, y, py, xi, pz, q = beam_matrix
-                    new_prop_dist = beam.prop_distance + (s+1)*t_step*ct.c
-                    beam_list.append(ParticleBunch(beam.q, x, y, xi, px, py, pz,
-                                                   prop_distance=new_prop_dist))
-            finally:
-                process_pool.close()
-                process_pool.join()
-        else:
-            # compute in single process
-            print('Serial computation.')
-            print('')
-            st_0 = "Tracking in {} step(s)... ".format(steps)
-            for s in np.arange(steps):
-                print_progress_bar(st_0, s, steps-1)
-                beam_matrix = runge_kutta_4(mat, WF=field, t0=s*t_step,
-                                            dt=dt_adjusted,
-                                            iterations=it_per_step)
-                x, px, y, py, xi, pz, q = copy(beam_matrix)
-                new_prop_dist = beam.prop_distance + (s+1)*t_step*ct.c
-                beam_list.append(
-                    ParticleBunch(beam.q, x, y, xi, px, py, pz,
-                                    prop_distance=new_prop_dist)
-                    )
+        snapshots = _track_phase_space(
+            field, coords, beam.q, t_step, dt_adjusted, it_per_step, steps,
+            parallel, n_proc, snapshot_every)
         end = time.time()
         print("Done ({:1.3f} seconds).".format(end-start))
         print('-'*80)
-        # update beam data
-        last_beam = beam_list[-1]
-        beam.set_phase_space(last_beam.x, last_beam.y, last_beam.xi,
-                             last_beam.px, last_beam.py, last_beam.pz)
-        beam.increase_prop_distance(self.length)
-        return beam_list
+        # create the output bunches and update beam data
+        return _get_tracked_beams(beam, snapshots, self.length)
     
     def _get_optimized_dt(self, beam, WF):
         gamma = self._gamma(beam.px, beam.py, beam.pz)
-        mean_gamma = np.average(gamma, weights=beam.q)
         Kx = WF.Kx(
             beam.x, beam.y, beam.xi, beam.px, beam.py, beam.pz, beam.q, gamma,
             0)
-        mean_Kx = np.average(Kx, weights=beam.q)
+        mean_gamma, mean_Kx = weighted_means(gamma, Kx, beam.q)
         w_x = np.sqrt(ct.e*ct.c/ct.m_e * mean_Kx/mean_gamma)
         T_x = 1/w_x
         dt = 0.1*T_x
         return dt
 
     def _gamma(self, px, py, pz):
-        return np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
+        return gamma_from_momentum(px, py, pz)
@@ -104,7 +104,7 @@ class ParticleBunch():
 
     def __init__(self, q, x=None, y=None, xi=None, px=None, py=None, pz=None,
                  bunch_matrix=None, matrix_type='standard', gamma_ref=None,
-                 tags=None, prop_distance=0, t_flight=0):
+                 tags=None, prop_distance=0, t_flight=0, dtype=np.float64):
         """
         Initialize particle bunch.
 
@@ -132,7 +132,8 @@ class ParticleBunch():
             phase-space information of the bunch. If provided, the argumets x
             to pz are not considered. The matrix contains (x, px, y, py, z, pz)
             if matrix_type='standard' or (x, x', y, y', xi, dp) if
-            matrix_type='alternative'.
+            matrix_type='alternative'. A 'standard' matrix is used as the
+            phase-space buffer of the bunch without making a copy.
         matrix_type : string
             Indicates the type of bunch_matrix. Possible values are 'standard'
             or 'alternative' (see above).
@@ -146,8 +147,12 @@ class ParticleBunch():
             Propagation distance of the bunch along the beamline.
         t_flight : float
             Time of flight of the bunch along the beamline.
+        dtype : data-type
+            Floating point type of the phase-space arrays of the bunch
+            (np.float64 or np.float32).
 
         """
+        self.dtype = np.dtype(dtype)
         if bunch_matrix is not None:
             if matrix_type == 'standard':
                 self.set_phase_space_from_matrix(bunch_matrix)
@@ -155,12 +160,7 @@ class ParticleBunch():
                 self.set_phase_space_from_alternative_matrix(bunch_matrix,
                                                              gamma_ref)
         else:
-            self.x = x
-            self.y = y
-            self.xi = xi
-            self.px = px
-            self.py = py
-            self.pz = pz
+            self.set_phase_space(x, y, xi, px, py, pz)
         self.q = q
         #self.mu = 0
         self.tags = tags
@@ -169,27 +169,88 @@ class ParticleBunch():
         self.x_ref = 0
         self.theta_ref = 0
 
+    # The coordinates are views of the rows x, px, y, py, xi, pz of a single
+    # 6 x N buffer. Assigning to them writes into the buffer, so use
+    # set_phase_space to change the number of particles.
+    @property
+    def x(self):
+        return self._data[0]
+
+    @x.setter
+    def x(self, value):
+        self._set_coordinate(0, value)
+
+    @property
+    def px(self):
+        return self._data[1]
+
+    @px.setter
+    def px(self, value):
+        self._set_coordinate(1, value)
+
+    @property
+    def y(self):
+        return self._data[2]
+
+    @y.setter
+    def y(self, value):
+        self._set_coordinate(2, value)
+
+    @property
+    def py(self):
+        return self._data[3]
+
+    @py.setter
+    def py(self, value):
+        self._set_coordinate(3, value)
+
+    @property
+    def xi(self):
+        return self._data[4]
+
+    @xi.setter
+    def xi(self, value):
+        self._set_coordinate(4, value)
+
+    @property
+    def pz(self):
+        return self._data[5]
+
+    @pz.setter
+    def pz(self, value):
+        self._set_coordinate(5, value)
+
+    def _set_coordinate(self, i, value):
+        value = np.asarray(value)
+        if value.shape != self._data[i].shape:
+            raise ValueError(
+                "Expected an array of shape {}, got shape {}. Use "
+                "set_phase_space to change the number of particles.".format(
+                    self._data[i].shape, value.shape))
+        self._data[i] = value
+
+    def __copy__(self):
+        """
+        Return a copy of the bunch with its own phase-space buffer, so that
+        modifying the coordinates of the copy does not modify this bunch.
+        """
+        bunch = self.__class__.__new__(self.__class__)
+        bunch.__dict__.update(self.__dict__)
+        bunch._data = self._data.copy()
+        return bunch
+
     def set_phase_space(self, x, y, xi, px, py, pz):
         """Sets the phase space coordinates"""
-        self.x = x
-        self.y = y
-        self.xi = xi
-        self.px = px
-        self.py = py
-        self.pz = pz
+        self._data = np.array([x, px, y, py, xi, pz], dtype=self.dtype)
 
     def set_phase_space_from_matrix(self, beam_matrix):
         """
         Sets the phase space coordinates from a matrix with the values of
-        (x, px, y, py, xi, pz).
+        (x, px, y, py, xi, pz). No copy is made if the matrix is already a
+        C-contiguous array of the bunch dtype.
         
         """
-        self.x = beam_matrix[0]
-        self.y = beam_matrix[2]
-        self.xi = beam_matrix[4]
-        self.px = beam_matrix[1]
-        self.py = beam_matrix[3]
-        self.pz = beam_matrix[5]
+        self._data = np.ascontiguousarray(beam_matrix, dtype=self.dtype)
 
     def set_phase_space_from_alternative_matrix(self, beam_matrix, gamma_ref):
         """
@@ -213,21 +274,15 @@ class ParticleBunch():
         dp = beam_matrix[5]
         gamma = (dp + 1)*gamma_ref
         p_kin = np.sqrt(gamma**2 - 1)
-        self.x = beam_matrix[0]
-        self.px = beam_matrix[1] * p_kin
-        self.y = beam_matrix[2]
-        self.py = beam_matrix[3] * p_kin
-        self.xi = beam_matrix[4]
-        self.pz = np.sqrt(gamma**2 - self.px**2 - self.py**2 - 1)
+        px = beam_matrix[1] * p_kin
+        py = beam_matrix[3] * p_kin
+        pz = np.sqrt(gamma**2 - px**2 - py**2 - 1)
+        self.set_phase_space(beam_matrix[0], beam_matrix[2], beam_matrix[4],
+                             px, py, pz)
 
     def set_bunch_matrix(self, beam_matrix):
         """Sets the 6D phase space and charge of the bunch"""
-        self.x = beam_matrix[0]
-        self.y = beam_matrix[1]
-        self.xi = beam_matrix[2]
-        self.px = beam_matrix[3]
-        self.py = beam_matrix[4]
-        self.pz = beam_matrix[5]
+        self.set_phase_space(*beam_matrix[:6])
         self.q = beam_matrix[6]
 
     def get_bunch_matrix(self):
@@ -238,9 +293,10 @@ class ParticleBunch():
     def get_6D_matrix(self):
         """
         Returns the 6D phase space matrix of the bunch containing
-        (x, px, y, py, xi, pz)
+        (x, px, y, py, xi, pz). This is the phase-space buffer of the bunch
+        (not a copy), so modifying it modifies the bunch.
         """
-        return np.array([self.x, self.px, self.y, self.py, self.xi, self.pz])
+        return self._data
 
     def get_6D_matrix_with_charge(self):
         """
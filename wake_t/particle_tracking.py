@@ -2,30 +2,225 @@
 
 import numpy as np
 import scipy.constants as ct
-from numba import jit, njit
+from numba import jit, njit, prange
 
 
-def runge_kutta_4(beam_matrix, WF, t0, dt, iterations):
+@njit(parallel=True, fastmath=True, cache=True)
+def rk4_step_linear_field(x, px, y, py, xi, pz, t0, dt, n_iter, wf_params):
+    """
+    Advance the particles by 'n_iter' iterations of a 4th order Runge-Kutta
+    method in a linear wakefield. The particle arrays are modified in place.
+
+    Parameters:
+    -----------
+    x, px, y, py, xi, pz : array
+        Phase space coordinates of the particles in units of (m, -, m, -, m,
+        -).
+
+    t0 : float
+        Time at the beginning of the first iteration.
+
+    dt : float
+        Time step of each iteration.
+
+    n_iter : int
+        Number of iterations to perform.
+
+    wf_params : tuple
+        Wakefield parameters (k_x, E_z_0, E_z_p, xi_shift) such that
+        W_x = c*k_x*x, W_y = c*k_x*y and W_z = E_z_0 + E_z_p*(xi + xi_shift*t)
+        (see Wakefield.get_kernel).
+
+    """
+    for i in prange(x.shape[0]):
+        x[i], px[i], y[i], py[i], xi[i], pz[i] = _rk4_particle_linear_field(
+            x[i], px[i], y[i], py[i], xi[i], pz[i], t0, dt, n_iter, wf_params)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def rk4_step_plasma_lens(x, px, y, py, xi, pz, t0, dt, n_iter, wf_params):
+    """
+    Advance the particles by 'n_iter' iterations of a 4th order Runge-Kutta
+    method in the azimuthal magnetic field of an active plasma lens. The
+    particle arrays are modified in place. The parameters are the same as in
+    'rk4_step_linear_field', with wf_params = (dB_r,) the magnetic field
+    gradient in units of T/m.
+    """
+    for i in prange(x.shape[0]):
+        x[i], px[i], y[i], py[i], xi[i], pz[i] = _rk4_particle_plasma_lens(
+            x[i], px[i], y[i], py[i], xi[i], pz[i], t0, dt, n_iter, wf_params)
+
+@njit(fastmath=True, cache=True)
+def _linear_field_eom(x, px, y, py, xi, pz, t, wf_params):
+    """ Equations of motion of a single particle in a linear wakefield """
+    k_x, e_z_0, e_z_p, xi_shift = wf_params
+    K = -ct.e/(ct.m_e*ct.c)
+    inv_gamma = 1/np.sqrt(1 + px*px + py*py + pz*pz)
+    return (px*ct.c*inv_gamma,
+            K*ct.c*k_x*x,
+            py*ct.c*inv_gamma,
+            K*ct.c*k_x*y,
+            (pz*inv_gamma - 1)*ct.c,
+            K*(e_z_0 + e_z_p*(xi + xi_shift*t)))
+
+@njit(fastmath=True, cache=True)
+def _plasma_lens_eom(x, px, y, py, xi, pz, t, wf_params):
+    """ Equations of motion of a single particle in an active plasma lens """
+    dB_r = wf_params[0]
+    K = -ct.e/(ct.m_e*ct.c)
+    inv_gamma = 1/np.sqrt(1 + px*px + py*py + pz*pz)
+    v_x = px*ct.c*inv_gamma
+    v_y = py*ct.c*inv_gamma
+    v_z = pz*ct.c*inv_gamma
+    return (v_x,
+            K*v_z*dB_r*x,
+            v_y,
+            K*v_z*dB_r*y,
+            v_z - ct.c,
+            -K*(v_x*x + v_y*y)*dB_r)
+
+def _make_rk4_particle(eom):
+    """
+    Return a jitted function that advances a single particle by 'n_iter'
+    Runge-Kutta iterations using the equations of motion 'eom'. Each
+    tracking kernel uses its own specialized integrator. The 'eom' is
+    bound in a closure instead of being passed as an argument, since
+    first-class function arguments prevent caching the kernels.
+    """
+    @njit(fastmath=True)
+    def rk4_particle(x, px, y, py, xi, pz, t0, dt, n_iter, wf_params):
+        for n in range(n_iter):
+            t = t0 + n*dt
+            A = eom(x, px, y, py, xi, pz, t, wf_params)
+            B = eom(x + dt*A[0]/2, px + dt*A[1]/2, y + dt*A[2]/2,
+                    py + dt*A[3]/2, xi + dt*A[4]/2, pz + dt*A[5]/2,
+                    t + dt/2, wf_params)
+            C = eom(x + dt*B[0]/2, px + dt*B[1]/2, y + dt*B[2]/2,
+                    py + dt*B[3]/2, xi + dt*B[4]/2, pz + dt*B[5]/2,
+                    t + dt/2, wf_params)
+            D = eom(x + dt*C[0], px + dt*C[1], y + dt*C[2],
+                    py + dt*C[3], xi + dt*C[4], pz + dt*C[5],
+                    t + dt, wf_params)
+            x += dt/6*(A[0] + 2*B[0] + 2*C[0] + D[0])
+            px += dt/6*(A[1] + 2*B[1] + 2*C[1] + D[1])
+            y += dt/6*(A[2] + 2*B[2] + 2*C[2] + D[2])
+            py += dt/6*(A[3] + 2*B[3] + 2*C[3] + D[3])
+            xi += dt/6*(A[4] + 2*B[4] + 2*C[4] + D[4])
+            pz += dt/6*(A[5] + 2*B[5] + 2*C[5] + D[5])
+        return x, px, y, py, xi, pz
+    return rk4_particle
+
+_rk4_particle_linear_field = _make_rk4_particle(_linear_field_eom)
+_rk4_particle_plasma_lens = _make_rk4_particle(_plasma_lens_eom)
+
+@njit(parallel=True, fastmath=True, cache=True, error_model='numpy')
+def analytic_step(t, g_0, w_0, xi_0, A_x, A_y, phi_x_0, phi_y_0, E, E_p, v_w,
+                  K, x, px, y, py, xi, pz):
+    """
+    Evaluate the analytical model from https://arxiv.org/abs/1804.10966 at
+    time 't' and store the phase space of each particle in the output arrays
+    (x, px, y, py, xi, pz). Returns the number of particles with an
+    unphysical energy, which are clamped to G = 1/g_0.
+    """
+    n_unphysical = 0
+    for i in prange(g_0.shape[0]):
+        G = 1 + E[i]/g_0[i]*t
+        if G < 1/g_0[i]:
+            # fix unphysical energies (model does not work well when E<=0)
+            n_unphysical += 1
+            G = 1/g_0[i]
+        sqrt_G = np.sqrt(G)
+        if E[i] == 0:
+            # apply limit when E->0
+            phi = np.sqrt(K[i]/g_0[i])*t
+        else:
+            phi = 2*np.sqrt(K[i]*g_0[i])/E[i]*(sqrt_G - 1)
+        A_0_sq = A_x[i]**2 + A_y[i]**2
+        G_14 = G**(-1/4)
+        G_34 = G_14*G_14*G_14
+
+        x[i] = A_x[i]*G_14*np.cos(phi + phi_x_0[i])
+        v_x = -w_0[i]*A_x[i]*G_34*np.sin(phi + phi_x_0[i])
+        px[i] = G*g_0[i]*v_x/ct.c
+
+        y[i] = A_y[i]*G_14*np.cos(phi + phi_y_0[i])
+        v_y = -w_0[i]*A_y[i]*G_34*np.sin(phi + phi_y_0[i])
+        py[i] = G*g_0[i]*v_y/ct.c
+
+        delta_xi = (ct.c/(2*E[i]*g_0[i])*(1/G - 1)
+                    + A_0_sq*K[i]/(2*ct.c*E[i])*(1/sqrt_G - 1))
+        xi[i] = xi_0[i] + delta_xi
+
+        delta_xi_max = -1/(2*E[i])*(ct.c/g_0[i] + A_0_sq*K[i]/ct.c)
+
+        g = (g_0[i] + E[i]*t + E_p[i]*delta_xi_max*t
+             + E_p[i]/2*(ct.c-v_w)*t**2
+             + ct.c*E_p[i]/(2*E[i]**2)*np.log(G)
+             + E_p[i]*A_0_sq*K[i]*g_0[i]/(ct.c*E[i]**2)*(sqrt_G - 1))
+        pz[i] = np.sqrt(g**2 - px[i]**2 - py[i]**2)
+    return n_unphysical
+
+@njit(nogil=True, fastmath=True, cache=True)
+def gamma_from_momentum(px, py, pz):
+    """
+    Calculate the Lorentz factor of the particles from their momentum
+    (px, py, pz) in non-dimensional units (beta*gamma).
+    """
+    gamma = np.empty_like(px)
+    for i in range(px.shape[0]):
+        gamma[i] = np.sqrt(1 + px[i]*px[i] + py[i]*py[i] + pz[i]*pz[i])
+    return gamma
+
+@njit(parallel=True, fastmath=True, cache=True)
+def weighted_mean_gamma(px, py, pz, w):
+    """ Get the weighted mean Lorentz factor of the particles in one pass """
+    s_g = 0.
+    s_w = 0.
+    for i in prange(w.shape[0]):
+        s_g += w[i]*np.sqrt(1 + px[i]*px[i] + py[i]*py[i] + pz[i]*pz[i])
+        s_w += w[i]
+    return s_g/s_w
+
+@njit(parallel=True, fastmath=True, cache=True)
+def weighted_means(a, b, w):
+    """ Get the weighted means of the arrays a and b in one pass """
+    s_a = 0.
+    s_b = 0.
+    s_w = 0.
+    for i in prange(w.shape[0]):
+        s_a += w[i]*a[i]
+        s_b += w[i]*b[i]
+        s_w += w[i]
+    return s_a/s_w, s_b/s_w
+
+def runge_kutta_4(x, px, y, py, xi, pz, q, WF, t0, dt, iterations,
+                  dtype=np.float64):
+    # keep the phase space and time step in the requested precision, so that
+    # float32 particles are not silently promoted
+    coords = tuple(np.asarray(u, dtype=dtype) for u in (x, px, y, py, xi, pz))
+    dt = np.dtype(dtype).type(dt)
     for i in np.arange(iterations):
         t = t0 + i*dt
-        A = dt*equations_of_motion(beam_matrix, t, WF)
-        B = dt*equations_of_motion(beam_matrix + A/2, t+dt/2, WF)
-        C = dt*equations_of_motion(beam_matrix + B/2, t+dt/2, WF)
-        D = dt*equations_of_motion(beam_matrix + C, t+dt, WF)
-        beam_matrix += 1/6*(A + 2*B + 2*C + D)
-    return beam_matrix
-
-def equations_of_motion(beam_matrix, t, WF):
+        A = [dt*d for d in equations_of_motion(*coords, q, t, WF)]
+        B = [dt*d for d in equations_of_motion(
+            *[u + a/2 for u, a in zip(coords, A)], q, t+dt/2, WF)]
+        C = [dt*d for d in equations_of_motion(
+            *[u + b/2 for u, b in zip(coords, B)], q, t+dt/2, WF)]
+        D = [dt*d for d in equations_of_motion(
+            *[u + c for u, c in zip(coords, C)], q, t+dt, WF)]
+        coords = tuple((u + 1/6*(a + 2*b + 2*c + d)).astype(dtype, copy=False)
+                       for u, a, b, c, d in zip(coords, A, B, C, D))
+    return coords
+
+def equations_of_motion(x, px, y, py, xi, pz, q, t, WF):
     K = -ct.e/(ct.m_e*ct.c)
-    x, px, y, py, xi, pz, q = beam_matrix
-    gamma = np.sqrt(1 + np.square(px) + np.square(py) + np.square(pz))
-    return np.array([px*ct.c/gamma,
-                     K*WF.Wx(x, y, xi, px, py, pz, q, gamma, t),
-                     py*ct.c/gamma,
-                     K*WF.Wy(x, y, xi, px, py, pz, q, gamma, t),
-                     (pz/gamma-1)*ct.c,
-                     K*WF.Wz(x, y, xi, px, py, pz, q, gamma, t),
-                     np.zeros_like(q)])
+    gamma = gamma_from_momentum(px, py, pz)
+    W_x, W_y, W_z = WF.Wxyz(x, y, xi, px, py, pz, q, gamma, t)
+    return (px*ct.c/gamma,
+            K*W_x,
+            py*ct.c/gamma,
+            K*W_y,
+            (pz/gamma-1)*ct.c,
+            K*W_z)
 
 def track_with_transfer_map(beam_matrix, z, L, theta, k1, k2, gamma_ref,
                             order=2):
@@ -2,16 +2,18 @@
 
 import numpy as np
 import scipy.constants as ct
-from scipy.stats import truncnorm
-import aptools.plasma_accel.general_equations as ge
+from scipy.special import ndtr, ndtri
+from numba import njit, prange
 import aptools.data_handling.reading as dr
 
 from wake_t.driver_witness import ParticleBunch
+from wake_t.utilities.other import matched_plasma_beta_function
 
 
 def get_gaussian_bunch_from_twiss(en_x, en_y, a_x, a_y, b_x, b_y, ene, ene_sp,
                                   s_t, xi_c, q_tot, n_part, x_off=0, y_off=0,
-                                  theta_x=0, theta_y=0):
+                                  theta_x=0, theta_y=0, seed=None,
+                                  dtype=np.float64):
     """
     Creates a 6D Gaussian particle bunch with the specified Twiss parameters.
 
@@ -49,6 +51,11 @@ def get_gaussian_bunch_from_twiss(en_x, en_y, a_x, a_y, b_x, b_y, ene, ene_sp,
         Pointing angle in the x-plane in radians.
     theta_y: float
         Pointing angle in the y-plane in radians.
+    seed: int
+        Seed of the random number generator. If None, a random seed is used.
+    dtype: data-type
+        Floating point type (np.float64 or np.float32) of the phase-space
+        arrays of the bunch.
     
     Returns:
     --------
@@ -74,29 +81,32 @@ def get_gaussian_bunch_from_twiss(en_x, en_y, a_x, a_y, b_x, b_y, ene, ene_sp,
     p_x_off = theta_x * ene
     p_y_off = theta_y * ene
     q_tot = q_tot/1e12
+    # Random number generator
+    rng = np.random.default_rng(seed)
     # Create normalized gaussian distributions
-    u_x = np.random.standard_normal(n_part)
-    v_x = np.random.standard_normal(n_part)
-    u_y = np.random.standard_normal(n_part)
-    v_y = np.random.standard_normal(n_part)
+    u_x, v_x, u_y, v_y = rng.standard_normal((4, n_part), dtype=dtype)
     # Calculate transverse particle distributions
-    x = s_x*u_x + x_off
-    xp = s_xp*(p_x*u_x + np.sqrt(1-np.square(p_x))*v_x)
-    y = s_y*u_y + y_off
-    yp = s_yp*(p_y*u_y + np.sqrt(1-np.square(p_y))*v_y)
+    x = np.empty(n_part, dtype=dtype)
+    xp = np.empty(n_part, dtype=dtype)
+    y = np.empty(n_part, dtype=dtype)
+    yp = np.empty(n_part, dtype=dtype)
+    _fill_gauss(u_x, v_x, u_y, v_y, s_x, s_xp, p_x, x_off, s_y, s_yp, p_y,
+                y_off, x, xp, y, yp)
     # Create longitudinal distributions (truncated at -3 and 3 sigma in xi)
-    xi = truncnorm.rvs(-3, 3,loc=xi_c,scale=s_z, size=n_part) # 
-    pz = np.random.normal(ene, ene_sp_abs, n_part)
+    # by inverting the CDF of uniform samples in [CDF(-3), CDF(3)]
+    u_z = rng.uniform(ndtr(-3), ndtr(3), n_part)
+    xi = xi_c + s_z*ndtri(u_z)
+    pz = rng.normal(ene, ene_sp_abs, n_part)
     # Change from slope to momentum and apply offset
     px = xp*pz + p_x_off
     py = yp*pz + p_y_off
     # Charge
     q = np.ones(n_part)*(q_tot/n_part)
-    return ParticleBunch(q, x, y, xi, px, py, pz)
+    return ParticleBunch(q, x, y, xi, px, py, pz, dtype=dtype)
 
 def get_gaussian_bunch_from_size(en_x, en_y, s_x, s_y, ene, ene_sp, s_t, xi_c,
                                  q_tot, n_part, x_off=0, y_off=0, theta_x=0,
-                                 theta_y=0):
+                                 theta_y=0, seed=None, dtype=np.float64):
     """
     Creates a Gaussian bunch with the specified emitance and spot size. It is
     assumed to be on its waist (alpha_x = alpha_y = 0)
@@ -131,6 +141,11 @@ def get_gaussian_bunch_from_size(en_x, en_y, s_x, s_y, ene, ene_sp, s_t, xi_c,
         Pointing angle in the x-plane in radians.
     theta_y: float
         Pointing angle in the y-plane in radians.
+    seed: int
+        Seed of the random number generator. If None, a random seed is used.
+    dtype: data-type
+        Floating point type (np.float64 or np.float32) of the phase-space
+        arrays of the bunch.
 
     Returns:
     --------
@@ -141,11 +156,12 @@ def get_gaussian_bunch_from_size(en_x, en_y, s_x, s_y, ene, ene_sp, s_t, xi_c,
     b_y = s_y**2*ene/en_y
     return get_gaussian_bunch_from_twiss(en_x, en_y, 0, 0, b_x, b_y, ene,
                                          ene_sp, s_t, xi_c, q_tot, n_part,
-                                         x_off, y_off, theta_x, theta_y)
+                                         x_off, y_off, theta_x, theta_y, seed,
+                                         dtype)
 
 def get_matched_bunch(en_x, en_y, ene, ene_sp, s_t, xi_c, q_tot, n_part,
                       x_off=0, y_off=0, theta_x=0, theta_y=0, n_p=None,
-                      k_x=None):
+                      k_x=None, seed=None, dtype=np.float64):
     """
     Creates a Gaussian bunch matched to the plasma focusing fields.
 
@@ -180,16 +196,24 @@ def get_matched_bunch(en_x, en_y, ene, ene_sp, s_t, xi_c, q_tot, n_part,
         focusing fields in the plasma assuming blowout regime.
     k_x: int
         Focusing fields in the plasma in units of T/m. Has priority over n_p.
+    seed: int
+        Seed of the random number generator. If None, a random seed is used.
+    dtype: data-type
+        Floating point type (np.float64 or np.float32) of the phase-space
+        arrays of the bunch.
 
     Returns:
     --------
     A ParticleBunch object.
 
     """
-    b_m = ge.matched_plasma_beta_function(ene, n_p*1e-6, k_x)
+    if n_p is not None:
+        n_p = n_p*1e-6
+    b_m = matched_plasma_beta_function(ene, n_p, k_x)
     return get_gaussian_bunch_from_twiss(en_x, en_y, 0, 0, b_m, b_m, ene, 
                                          ene_sp, s_t, xi_c, q_tot, n_part,
-                                         x_off, y_off, theta_x, theta_y)
+                                         x_off, y_off, theta_x, theta_y, seed,
+                                         dtype)
 
 def get_from_file(file_path, code_name, preserve_prop_dist=False, **kwargs):
     x, y, z, px, py, pz, q = dr.read_beam(code_name, file_path, **kwargs)
@@ -199,3 +223,18 @@ def get_from_file(file_path, code_name, preserve_prop_dist=False, **kwargs):
     if preserve_prop_dist:
         bunch.prop_distance = z_avg
     return bunch
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _fill_gauss(u_x, v_x, u_y, v_y, s_x, s_xp, p_x, x_off, s_y, s_yp, p_y,
+                y_off, x, xp, y, yp):
+    """
+    Fill the transverse distributions (x, xp, y, yp) of a Gaussian bunch from
+    the normalized samples (u_x, v_x, u_y, v_y) in a single pass.
+    """
+    c_x = np.sqrt(1 - p_x*p_x)
+    c_y = np.sqrt(1 - p_y*p_y)
+    for i in prange(u_x.shape[0]):
+        x[i] = s_x*u_x[i] + x_off
+        xp[i] = s_xp*(p_x*u_x[i] + c_x*v_x[i])
+        y[i] = s_y*u_y[i] + y_off
+        yp[i] = s_yp*(p_y*u_y[i] + c_y*v_y[i])
@@ -0,0 +1,99 @@
+""" This module contains fast interpolators for fields on uniform grids """
+
+from numba import njit
+
+
+# tolerance (in units of the grid spacing) for points on the grid edges
+_EPS = 1e-9
+
+# fast-math flags without 'nnan' and 'ninf', since the bounds check has to
+# handle non-finite coordinates (they are masked as outside of the grid)
+_FASTMATH = {'contract', 'arcp', 'afn', 'reassoc', 'nsz'}
+
+
+@njit(nogil=True, fastmath=_FASTMATH, cache=True)
+def interp2d_uniform(vals, x_0, dx, y_0, dy, x, y, out):
+    """
+    Bilinear interpolation of the values of a field on a uniform 2D grid at
+    the points (x, y). Points outside of the grid get a value of 0.
+
+    Parameters:
+    -----------
+    vals : array
+        2D array with the field values at the grid nodes, with shape
+        (n_x, n_y).
+
+    x_0, y_0 : float
+        Position of the first grid node along each axis.
+
+    dx, dy : float
+        Grid spacing along each axis.
+
+    x, y : array
+        Coordinates of the points at which to interpolate.
+
+    out : array
+        Array in which to store the interpolated values.
+
+    Returns:
+    --------
+    The 'out' array.
+
+    """
+    n_x, n_y = vals.shape
+    for k in range(x.shape[0]):
+        f_x = (x[k] - x_0)/dx
+        f_y = (y[k] - y_0)/dy
+        # points outside of the grid are interpolated at the first node and
+        # then masked, which avoids branching in the loop (the tolerance
+        # keeps points on the grid edges inside despite round-off errors)
+        inside = ((-_EPS <= f_x <= n_x - 1 + _EPS)
+                  & (-_EPS <= f_y <= n_y - 1 + _EPS))
+        f_x = f_x if inside else 0.
+        f_y = f_y if inside else 0.
+        i = min(int(f_x), n_x - 2)
+        j = min(int(f_y), n_y - 2)
+        w_x = f_x - i
+        w_y = f_y - j
+        out[k] = inside*((1-w_x)*((1-w_y)*vals[i, j] + w_y*vals[i, j+1])
+                         + w_x*((1-w_y)*vals[i+1, j] + w_y*vals[i+1, j+1]))
+    return out
+
+
+@njit(nogil=True, fastmath=_FASTMATH, cache=True)
+def interp3d_uniform(vals, x_0, dx, y_0, dy, z_0, dz, x, y, z, out):
+    """
+    Trilinear interpolation of the values of a field on a uniform 3D grid at
+    the points (x, y, z). Points outside of the grid get a value of 0. The
+    parameters are the same as in 'interp2d_uniform' with an additional
+    third axis.
+    """
+    n_x, n_y, n_z = vals.shape
+    for k in range(x.shape[0]):
+        f_x = (x[k] - x_0)/dx
+        f_y = (y[k] - y_0)/dy
+        f_z = (z[k] - z_0)/dz
+        inside = ((-_EPS <= f_x <= n_x - 1 + _EPS)
+                  & (-_EPS <= f_y <= n_y - 1 + _EPS)
+                  & (-_EPS <= f_z <= n_z - 1 + _EPS))
+        f_x = f_x if inside else 0.
+        f_y = f_y if inside else 0.
+        f_z = f_z if inside else 0.
+        i = min(int(f_x), n_x - 2)
+        j = min(int(f_y), n_y - 2)
+        l = min(int(f_z), n_z - 2)
+        w_x = f_x - i
+        w_y = f_y - j
+        w_z = f_z - l
+        v_00 = (1-w_z)*vals[i, j, l] + w_z*vals[i, j, l+1]
+        v_01 = (1-w_z)*vals[i, j+1, l] + w_z*vals[i, j+1, l+1]
+        v_10 = (1-w_z)*vals[i+1, j, l] + w_z*vals[i+1, j, l+1]
+        v_11 = (1-w_z)*vals[i+1, j+1, l] + w_z*vals[i+1, j+1, l+1]
+        out[k] = inside*((1-w_x)*((1-w_y)*v_00 + w_y*v_01)
+                         + w_x*((1-w_y)*v_10 + w_y*v_11))
+    return out
+
+
+def get_uniform_grid(axis):
+    """ Return the origin and spacing of a uniformly spaced axis """
+    return axis[0], (axis[-1] - axis[0])/(len(axis) - 1)
@@ -1,13 +1,46 @@
 """ Contains other utilities """
 
 import sys
+from functools import lru_cache
+
+import aptools.plasma_accel.general_equations as ge
 
 
 def print_progress_bar(pre_string, step, total_steps):
-    n_dash = int(round(step/total_steps*20))
+    if total_steps > 0:
+        n_dash = int(round(step/total_steps*20))
+        n_dash_prev = int(round((step-1)/total_steps*20))
+    else:
+        n_dash = 20
+        n_dash_prev = -1
+    # only write to stdout when the bar changes (and at the first and last
+    # steps), instead of flushing at every step
+    if 0 < step < total_steps and n_dash == n_dash_prev:
+        return
     n_space = 20 - n_dash
     status = pre_string + '[' + '-'*n_dash + ' '*n_space + '] '
     if step < total_steps:
         status += '\r'
     sys.stdout.write(status)
     sys.stdout.flush()
+
+
+def matched_plasma_beta_function(beam_ene, n_p=None, k_x=None,
+                                 regime='Blowout', dist_from_driver=None,
+                                 a_0=None, w_0=None):
+    """
+    Memoized version of 'matched_plasma_beta_function' from aptools (see its
+    documentation for the meaning and units of the parameters). Calls with
+    unhashable arguments, such as arrays, are not cached.
+    """
+    args = (beam_ene, n_p, k_x, regime, dist_from_driver, a_0, w_0)
+    try:
+        hash(args)
+    except TypeError:
+        return ge.matched_plasma_beta_function(*args)
+    return _cached_matched_plasma_beta_function(*args)
+
+
+@lru_cache(maxsize=1024)
+def _cached_matched_plasma_beta_function(*args):
+    return ge.matched_plasma_beta_function(*args)
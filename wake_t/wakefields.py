@@ -1,11 +1,25 @@
 """ This module contains the possible plasma wakefields """
 
+from functools import lru_cache
+
 import numpy as np
 import scipy.constants as ct
-from scipy.interpolate import RegularGridInterpolator
+from scipy import ndimage
 from aptools.plasma_accel.general_equations import (
     plasma_skin_depth, plasma_cold_non_relativisct_wave_breaking_field)
 import matplotlib.pyplot as plt
+from numba import njit
+try:
+    # importing numba.cuda does not initialize the CUDA driver
+    from numba import cuda
+    cuda_installed = True
+except ImportError:
+    cuda_installed = False
+
+from wake_t.particle_tracking import (rk4_step_linear_field,
+                                      rk4_step_plasma_lens)
+from wake_t.utilities.fast_interp import (interp2d_uniform, interp3d_uniform,
+                                          get_uniform_grid)
 try:
     from VisualPIC.DataHandling.dataContainer import DataContainer
     vpic_installed = True
@@ -26,12 +40,57 @@ class Wakefield():
     def Wy(self, x, y, xi, px, py, pz, q, gamma, t):
         raise NotImplementedError
 
+    def Wxy(self, x, y, xi, px, py, pz, q, gamma, t):
+        """
+        Return a tuple (Wx, Wy) with both transverse wakefields. Wakefields
+        which can compute both at once (e.g. from a single interpolation)
+        should override this method.
+        """
+        return (self.Wx(x, y, xi, px, py, pz, q, gamma, t),
+                self.Wy(x, y, xi, px, py, pz, q, gamma, t))
+
+    def Wxyz(self, x, y, xi, px, py, pz, q, gamma, t):
+        """
+        Return a tuple (Wx, Wy, Wz) with the transverse and longitudinal
+        wakefields. Wakefields which share work between them (e.g. the
+        radial position of the particles) should override this method.
+        """
+        return (*self.Wxy(x, y, xi, px, py, pz, q, gamma, t),
+                self.Wz(x, y, xi, px, py, pz, q, gamma, t))
+
     def Wz(self, x, y, xi, px, py, pz, q, gamma, t):
+        """
+        Return the longitudinal wakefield. Fields which are uniform along the
+        bunch can be returned as read-only broadcast views (np.broadcast_to)
+        instead of new arrays, so callers must not modify the result in
+        place.
+        """
         raise NotImplementedError
 
     def Kx(self, x, y, xi, px, py, pz, q, gamma, t):
+        """
+        Return the focusing gradient. As in 'Wz', the result can be a
+        read-only broadcast view and must not be modified in place.
+        """
         raise NotImplementedError
 
+    def check_if_update_fields(self, time):
+        """
+        Update the fields if needed at the given time. Returns True if the
+        fields were updated. Only fields read from a simulation are updated.
+        """
+        return False
+
+    def get_kernel(self):
+        """
+        Return a tuple (kernel, parameters) with the Numba tracking kernel
+        specialized for this kind of field (see 'rk4_step_linear_field' and
+        'rk4_step_plasma_lens') and the parameters of the field it needs.
+        Wakefields without a specialized kernel return None and are tracked
+        with the generic Runge-Kutta solver.
+        """
+        return None
+
 
 class CustomBlowoutWakefield(Wakefield):
     def __init__(self, n_p, driver, beam_center, lon_field=None,
@@ -54,6 +113,8 @@ class CustomBlowoutWakefield(Wakefield):
         self.E_z_p = lon_field_slope
         self.l_c = self.driver.xi_c
         self.b_w = self.driver.get_group_velocity(self.n_p)
+        # velocity at which xi of the wake shifts in the speed-of-light frame
+        self.v_slip = (1-self.b_w)*ct.c
 
     def Wx(self, x, y, xi, px, py, pz, q, gamma, t):
         return ct.c*self.g_x*x
@@ -62,25 +123,57 @@ class CustomBlowoutWakefield(Wakefield):
         return ct.c*self.g_x*y
 
     def Wz(self, x, y, xi, px, py, pz, q, gamma, t):
-        return self.E_z_0 + self.E_z_p*(xi - self.field_off - self.xi_c
-                                        + (1-self.b_w)*ct.c*t)
+        E_z_0 = self.E_z_0 + self.E_z_p*(self.v_slip*t - self.field_off
+                                         - self.xi_c)
+        return E_z_0 + self.E_z_p*xi
 
     def Kx(self, x, y, xi, px, py, pz, q, gamma, t):
-        return self.g_x*np.ones_like(x)
+        return np.broadcast_to(self.g_x, x.shape)
+
+    def get_kernel(self):
+        E_z_0 = self.E_z_0 - self.E_z_p*(self.field_off + self.xi_c)
+        return rk4_step_linear_field, (float(self.g_x), float(E_z_0),
+                                       float(self.E_z_p), self.v_slip)
+
+
+class BlowoutWakefield(CustomBlowoutWakefield):
+    def __init__(self, n_p, driver, field_offset=0):
+        """
+        Linear fields of the blowout regime. The focusing gradient and the
+        slope of the accelerating field are determined by the plasma density,
+        and the bubble center (where E_z = 0) is assumed at lambda_p/2 behind
+        the driver.
+
+        [n_p] = m^-3
+        """
+        self.n_p = n_p
+        self.field_off = field_offset
+        self.driver = driver
+        w_p_sq = n_p*ct.e**2/(ct.m_e*ct.epsilon_0)
+        l_p = 2*np.pi*ct.c/np.sqrt(w_p_sq)
+        self.xi_c = driver.xi_c - l_p/2
+        self._calculate_base_quantities(
+            0, n_p*ct.e/(2*ct.epsilon_0), ct.m_e*w_p_sq/(2*ct.e*ct.c))
 
 
 class WakefieldFromPICSimulation(Wakefield):
     def __init__(self, simulation_code, simulation_path, driver, timestep,
                  n_p=None, filter_fields=False, sigma_filter=20,
-                 reverse_tracking=False):
+                 reverse_tracking=False, field_dtype=np.float32):
         """
         [n_p] = m^-3
+
+        The field data is stored with 'field_dtype' (single precision by
+        default), which halves the memory traffic of the interpolation.
+        The interpolated fields are always double precision.
         """
         self.driver = driver
         self.b_w = driver.get_group_velocity(n_p)
+        self.v_slip = (1-self.b_w)*ct.c
         self.filter_fields = filter_fields
         self.sigma_filter = sigma_filter
         self.reverse_tracking = reverse_tracking
+        self.field_dtype = field_dtype
         self._load_fields(simulation_code, simulation_path, driver, timestep,
                           n_p)
 
@@ -105,29 +198,28 @@ class WakefieldFromPICSimulation(Wakefield):
         #todo: implement separate components for transverse fields
 
     def check_if_update_fields(self, time):
-        possible_ts = np.where(self.timesteps_in_sec<time)[0]
-        if len(possible_ts) > 1:
-            if not self.reverse_tracking:
-                requested_ts_index = possible_ts[-1]
-                current_ts_index = np.where(
-                    self.timesteps==self.current_ts)[0][0]
-                if current_ts_index < requested_ts_index:
-                    # update current time step
-                    self.current_ts = self.timesteps[requested_ts_index]
-                    print("Updating fields using timestep {} ...".format(
-                        self.current_ts))
-                    self.create_fields()
-                    print("Done.")
-            else:
-                requested_ts_index = possible_ts[0]
-                current_ts_index = np.where(
-                    self.timesteps==self.current_ts)[0][0]
-                if current_ts_index > requested_ts_index:
-                    self.current_ts = self.timesteps[requested_ts_index]
-                    print("Updating fields using timestep {} ...".format(
-                        self.current_ts))
-                    self.create_fields()
-                    print("Done.")
+        """
+        Update the fields if a newer (older, if reverse_tracking) time step
+        of the simulation should be used at the given time. Returns True if
+        the fields were updated.
+        """
+        # fast path: fields are only updated once the time goes beyond
+        # the next (previous, if reverse_tracking) time step.
+        if not time > self._next_update_time:
+            return False
+        # number of time steps before the given time
+        if not self.reverse_tracking:
+            n_before = np.searchsorted(self.timesteps_in_sec, time)
+            requested_ts_index = n_before - 1
+        else:
+            n_before = np.searchsorted(self.timesteps_in_sec[::-1], time)
+            requested_ts_index = len(self.timesteps_in_sec) - n_before
+        self.current_ts = self.timesteps[requested_ts_index]
+        print("Updating fields using timestep {} ...".format(
+            self.current_ts))
+        self.create_fields()
+        print("Done.")
+        return True
 
     def create_fields(self):
         # Simulation geometry
@@ -161,27 +253,17 @@ class WakefieldFromPICSimulation(Wakefield):
             xi_axis = z_axis - np.min(z_axis)
             r_axis = E_z_field.GetAxisInISUnits("r", self.current_ts)
 
-        # create interpolation functions
-        if geom == "3D":
-            self.E_z = RegularGridInterpolator((x_axis, y_axis, xi_axis),
-                                               E_z_data, fill_value=0,
-                                               bounds_error=False)
-            self.W_x = RegularGridInterpolator((x_axis, y_axis, xi_axis),
-                                               W_x_data, fill_value=0,
-                                               bounds_error=False)
-            self.K_x = RegularGridInterpolator((x_axis, y_axis, xi_axis),
-                                               K_x_data, fill_value=0,
-                                               bounds_error=False)
+        # store geometry, field data and grid for the interpolators
+        self.is_3d = geom == "3D"
+        if self.is_3d:
+            self.grid = (*get_uniform_grid(x_axis), *get_uniform_grid(y_axis),
+                         *get_uniform_grid(xi_axis))
         elif geom == "thetaMode":
-            self.E_z = RegularGridInterpolator((r_axis, xi_axis), E_z_data,
-                                               fill_value=0,
-                                               bounds_error=False)
-            self.W_x = RegularGridInterpolator((r_axis, xi_axis), W_x_data,
-                                               fill_value=0,
-                                               bounds_error=False)
-            self.K_x = RegularGridInterpolator((r_axis, xi_axis), K_x_data,
-                                               fill_value=0,
-                                               bounds_error=False)
+            self.grid = (*get_uniform_grid(r_axis),
+                         *get_uniform_grid(xi_axis))
+        self.E_z_data = np.ascontiguousarray(E_z_data, dtype=self.field_dtype)
+        self.W_x_data = np.ascontiguousarray(W_x_data, dtype=self.field_dtype)
+        self.K_x_data = np.ascontiguousarray(K_x_data, dtype=self.field_dtype)
 
         if len(self.timesteps) == 0:
             self.timesteps = E_z_field.GetTimeSteps()
@@ -196,50 +278,86 @@ class WakefieldFromPICSimulation(Wakefield):
                     :current_ts_index+1]
                 self.timesteps_in_sec = self.timesteps_in_sec[::-1]
 
+        # time after which the fields should be updated
+        current_ts_index = np.where(self.timesteps==self.current_ts)[0][0]
+        if not self.reverse_tracking:
+            next_ts_index = current_ts_index + 1
+        else:
+            next_ts_index = current_ts_index - 1
+        if 0 <= next_ts_index < len(self.timesteps_in_sec):
+            self._next_update_time = self.timesteps_in_sec[next_ts_index]
+        else:
+            self._next_update_time = np.inf
+
     def Wx(self, x, y, xi, px, py, pz, q, gamma, t):
-        geom = self.dc.GetSimulationDimension()
-        # matrix of coordinate points
-        if geom == "3D":
-            R = np.array([x, y, xi + (1-self.b_w)*ct.c*t]).T
-        elif geom == "thetaMode":
-            R = np.array([np.sqrt(np.square(x)+np.square(y)),
-                          xi + (1-self.b_w)*ct.c*t]).T
-            theta = np.arctan2(x, y)
-        return self.W_x(R)*np.sin(theta)
+        if self.is_3d:
+            return self._interpolate(self.W_x_data, t, x, y, xi)
+        else:
+            r, sin_t, cos_t = _to_cylindrical(x, y)
+            return self._interpolate(self.W_x_data, t, r, xi)*sin_t
 
     def Wy(self, x, y, xi, px, py, pz, q, gamma, t):
-        geom = self.dc.GetSimulationDimension()
-        if geom == "3D":
-            R = np.array([y, x, xi + (1-self.b_w)*ct.c*t]).T
-        elif geom == "thetaMode":
-            R = np.array([np.sqrt(np.square(x)+np.square(y)),
-                          xi + (1-self.b_w)*ct.c*t]).T
-            theta = np.arctan2(x, y)
-        return self.W_x(R)*np.cos(theta)
+        if self.is_3d:
+            return self._interpolate(self.W_x_data, t, y, x, xi)
+        else:
+            r, sin_t, cos_t = _to_cylindrical(x, y)
+            return self._interpolate(self.W_x_data, t, r, xi)*cos_t
+
+    def Wxy(self, x, y, xi, px, py, pz, q, gamma, t):
+        if self.is_3d:
+            return (self._interpolate(self.W_x_data, t, x, y, xi),
+                    self._interpolate(self.W_x_data, t, y, x, xi))
+        else:
+            r, sin_t, cos_t = _to_cylindrical(x, y)
+            W_r = self._interpolate(self.W_x_data, t, r, xi)
+            return W_r*sin_t, W_r*cos_t
+
+    def Wxyz(self, x, y, xi, px, py, pz, q, gamma, t):
+        if self.is_3d:
+            return (*self.Wxy(x, y, xi, px, py, pz, q, gamma, t),
+                    self._interpolate(self.E_z_data, t, x, y, xi))
+        else:
+            r, sin_t, cos_t = _to_cylindrical(x, y)
+            W_r = self._interpolate(self.W_x_data, t, r, xi)
+            return (W_r*sin_t, W_r*cos_t,
+                    self._interpolate(self.E_z_data, t, r, xi))
 
     def Wz(self, x, y, xi, px, py, pz, q, gamma, t):
-        geom = self.dc.GetSimulationDimension()
-        if geom == "3D":
-            R = np.array([x, y, xi + (1-self.b_w)*ct.c*t]).T
-        elif geom == "thetaMode":
-            R = np.array([np.sqrt(np.square(x)+np.square(y)),
-                          xi + (1-self.b_w)*ct.c*t]).T
-        return self.E_z(R)
+        if self.is_3d:
+            return self._interpolate(self.E_z_data, t, x, y, xi)
+        else:
+            r = np.hypot(x, y)
+            return self._interpolate(self.E_z_data, t, r, xi)
 
     def Kx(self, x, y, xi, px, py, pz, q, gamma, t):
-        geom = self.dc.GetSimulationDimension()
-        # matrix of coordinate points
-        if geom == "3D":
-            R = np.array([x, y, xi + (1-self.b_w)*ct.c*t]).T
-        elif geom == "thetaMode":
-            R = np.array([np.sqrt(np.square(x)+np.square(y)),
-                          xi + (1-self.b_w)*ct.c*t]).T
-        return self.K_x(R)
+        if self.is_3d:
+            return self._interpolate(self.K_x_data, t, x, y, xi)
+        else:
+            r = np.hypot(x, y)
+            return self._interpolate(self.K_x_data, t, r, xi)
+
+    def _interpolate(self, field_data, t, *coords):
+        """
+        Interpolate the field data at time t at the given coordinates, which
+        are (x, y, xi) in 3D and (r, xi) in thetaMode. Values outside the
+        grid are 0. The slippage of the wake in xi is applied by shifting the
+        origin of the grid instead of the particle coordinates.
+        """
+        out = np.empty(len(coords[0]))
+        *grid, xi_0, dxi = self.grid
+        xi_0 -= self.v_slip*t
+        if len(coords) == 3:
+            return interp3d_uniform(field_data, *grid, xi_0, dxi, *coords,
+                                    out)
+        else:
+            return interp2d_uniform(field_data, *grid, xi_0, dxi, *coords,
+                                    out)
 
 
 class NonLinearColdFluidWakefield(Wakefield):
     def __init__(self, density_function, driver, driver_evolution,
-                 driver_z_foc, r_max, xi_min, xi_max, n_r, n_xi):
+                 driver_z_foc, r_max, xi_min, xi_max, n_r, n_xi,
+                 use_cuda=False):
         self.density_function = density_function
         self.driver = driver
         self.driver_evolution = driver_evolution
@@ -251,12 +369,33 @@ class NonLinearColdFluidWakefield(Wakefield):
         self.n_xi = n_xi
         self.current_t = -1
         self.current_n_p = None
+        if use_cuda and not _is_cuda_available():
+            print("CUDA is not available. "
+                  "Wakefields will be calculated on the CPU.")
+            use_cuda = False
+        self.use_cuda = use_cuda
+        # buffers for the solution of the wakefield equations, reused in
+        # every field calculation
+        self._u_1 = np.zeros((n_xi, n_r))
+        self._u_2 = np.zeros((n_xi, n_r))
+
+    def __copy__(self):
+        """
+        Return a shallow copy with its own solver buffers, so that the copy
+        can calculate the fields concurrently with this wakefield (e.g., when
+        tracking in several threads).
+        """
+        wf = self.__class__.__new__(self.__class__)
+        wf.__dict__.update(self.__dict__)
+        wf._u_1 = np.zeros_like(self._u_1)
+        wf._u_2 = np.zeros_like(self._u_2)
+        return wf
 
-    def __wakefield_ode_system(self, u_1, u_2, r, z, laser_a0, n_beam):
-        #return np.array([u_2, (1+laser_a0**2)/(2*(1+u_1)**2) + n_beam - 1/2])
-        return np.array([u_2, (1+laser_a0**2)/(2*(1+u_1)**2) - 1/2])
-
-    def __calculate_wakefields(self, x, y, xi, px, py, pz, q, gamma, t):
+    def __calculate_wakefields(self, xi, t):
+        """
+        Calculate the wakefields at time t (if needed), using the plasma
+        density at the center of the particles with longitudinal positions xi.
+        """
         if self.current_t != t:
             self.current_t = t
         else:
@@ -274,106 +413,114 @@ class NonLinearColdFluidWakefield(Wakefield):
         r = np.linspace(0, self.r_max, self.n_r)
         dz = (self.xi_max - self.xi_min) / self.n_xi / s_d
         dr = self.r_max / self.n_r / s_d
-        r_part = np.sqrt(x**2 + y**2)
-        beam_hist, *_ = np.histogram2d(xi, r_part,
-                                   bins=[self.n_xi, self.n_r],
-                                   range=[[self.xi_min, self.xi_max],
-                                          [0, self.r_max]],
-                                   weights=q/ct.e)
-                                   #,
-                                   #weights=1/(ct.pi*dr*2*dz))
-        n = np.arange(self.n_r)
-        disc_area = np.pi * dr**2*(1+2*n)
-        beam_hist *= 1/(disc_area*dz*n_p)/s_d**3
         n_iter = self.n_xi - 1
-        u_1 = np.zeros((n_iter+1, len(r)))
-        u_2 = np.zeros((n_iter+1, len(r)))
-        z_arr = np.zeros(n_iter+1) 
-        z_arr[-1] = self.xi_max / s_d
+        # only the initial values need to be reset
+        u_1 = self._u_1
+        u_2 = self._u_2
+        u_1[-1] = 0
+        u_2[-1] = 0
+        z_arr = self.xi_max / s_d - np.arange(n_iter, -1, -1)*dz
         # calculate distance to laser focus
         if self.driver_evolution:
             dist_z_foc = self.driver_z_foc - ct.c*t
         else:
             dist_z_foc = 0
-        for i in np.arange(n_iter):
-            z = z_arr[-1] - i*dz
-            # get laser a0 at z, z+dz/2 and z+dz
-            a0_0 = self.driver.get_a0_profile(r, z*s_d, dist_z_foc)
-            a0_1 = self.driver.get_a0_profile(r, (z - dz/2)*s_d, dist_z_foc)
-            a0_2 = self.driver.get_a0_profile(r, (z - dz)*s_d, dist_z_foc)
-            # perform runge-kutta
-            A = dz*self.__wakefield_ode_system(
-                u_1[-1-i], u_2[-1-i], r, z*s_d, a0_0, beam_hist[-(i+1)])
-            B = dz*self.__wakefield_ode_system(
-                u_1[-1-i] + A[0]/2, u_2[-1-i] + A[1]/2, r, (z - dz/2)*s_d,
-                a0_1, beam_hist[-(i+1)])
-            C = dz*self.__wakefield_ode_system(
-                u_1[-1-i] + B[0]/2, u_2[-1-i] + B[1]/2, r, (z - dz/2)*s_d,
-                a0_1, beam_hist[-(i+1)])
-            D = dz*self.__wakefield_ode_system(
-                u_1[-1-i] + C[0], u_2[-1-i] + C[1], r, (z - dz)*s_d, a0_2,
-                beam_hist[-(i+1)])
-            u_1[-2-i] = u_1[-1-i] + 1/6*(A[0] + 2*B[0] + 2*C[0] + D[0])
-            u_2[-2-i] = u_2[-1-i] + 1/6*(A[1] + 2*B[1] + 2*C[1] + D[1])
-            z_arr[-2-i] = z - dz
-        E_z = -np.gradient(u_1, dz, axis=0, edge_order=2)
-        W_r = -np.gradient(u_1, dr, axis=1, edge_order=2)
-        K_r = np.gradient(W_r, dr, axis=1, edge_order=2)
+        # get laser a0 at z, z-dz/2 and z-dz for each RK4 step
+        z_steps = z_arr[:0:-1, np.newaxis]
+        a0_table = np.empty((n_iter, len(r), 3))
+        for k in np.arange(3):
+            a0_table[:, :, k] = self.driver.get_a0_profile(
+                r, (z_steps - k*dz/2)*s_d, dist_z_foc)
+        # perform runge-kutta
+        if self.use_cuda:
+            _rk4_wakefield_sweep_on_gpu(u_1, u_2, a0_table, dz)
+        else:
+            _rk4_wakefield_sweep(u_1, u_2, a0_table, dz)
+        E_z = np.empty_like(u_1)
+        W_r = np.empty_like(u_1)
+        K_r = np.empty_like(u_1)
+        _calculate_fields_from_potential(u_1, dz, dr, E_z, W_r, K_r)
         E_0 = plasma_cold_non_relativisct_wave_breaking_field(n_p*1e-6)
         
         ## For debugging
         #E_z_p = np.gradient(E_z, dz, axis=0, edge_order=2)
-        #plt.subplot(411)
+        #plt.subplot(311)
         #plt.imshow(E_z.T*E_0, aspect='auto',
         #           extent=(self.xi_min, self.xi_max, 0, self.r_max))
         ##plt.plot(E_z[:,0]*E_0)
-        #plt.subplot(412)
+        #plt.subplot(312)
         #plt.imshow(K_r.T*E_0/s_d, aspect='auto',
         #           extent=(self.xi_min, self.xi_max, 0, self.r_max))
-        #plt.subplot(413)
+        #plt.subplot(313)
         #plt.imshow(E_z_p.T*E_0/s_d, aspect='auto',
         #           extent=(self.xi_min, self.xi_max, 0, self.r_max))
-        #plt.subplot(414)
-        #plt.imshow(beam_hist.T, aspect='auto',
-        #           extent=(self.xi_min, self.xi_max, 0, self.r_max))
         #plt.show()
 
-        self.E_z = RegularGridInterpolator((z_arr*s_d, r), E_z*E_0,
-                                            fill_value=0,
-                                            bounds_error=False)
-        self.W_x = RegularGridInterpolator((z_arr*s_d, r), W_r*E_0,
-                                            fill_value=0,
-                                            bounds_error=False)
-        self.K_x = RegularGridInterpolator((z_arr*s_d, r), K_r*E_0/s_d,
-                                            fill_value=0,
-                                            bounds_error=False)
+        # store field data and (uniform) grid for the interpolators
+        self.grid = (z_arr[0]*s_d, dz*s_d, *get_uniform_grid(r))
+        # scale in place, the arrays are new at every rebuild
+        E_z *= E_0
+        W_r *= E_0
+        K_r *= E_0/s_d
+        self.E_z_data = E_z
+        self.W_x_data = W_r
+        self.K_x_data = K_r
 
     def Wx(self, x, y, xi, px, py, pz, q, gamma, t):
-        self.__calculate_wakefields(x, y, xi, px, py, pz, q, gamma, t)
-        R = np.array([xi, np.sqrt(np.square(x)+np.square(y))]).T
-        theta = np.arctan2(x, y)
-        return self.W_x(R) * np.sin(theta)
+        r, sin_t, cos_t = _to_cylindrical(x, y)
+        self.__calculate_wakefields(xi, t)
+        return self._interpolate(self.W_x_data, xi, r)*sin_t
 
     def Wy(self, x, y, xi, px, py, pz, q, gamma, t):
-        self.__calculate_wakefields(x, y, xi, px, py, pz, q, gamma, t)
-        R = np.array([xi, np.sqrt(np.square(x)+np.square(y))]).T
-        theta = np.arctan2(x, y)
-        return self.W_x(R)*np.cos(theta)
+        r, sin_t, cos_t = _to_cylindrical(x, y)
+        self.__calculate_wakefields(xi, t)
+        return self._interpolate(self.W_x_data, xi, r)*cos_t
+
+    def Wxy(self, x, y, xi, px, py, pz, q, gamma, t):
+        r, sin_t, cos_t = _to_cylindrical(x, y)
+        self.__calculate_wakefields(xi, t)
+        W_r = self._interpolate(self.W_x_data, xi, r)
+        return W_r*sin_t, W_r*cos_t
+
+    def Wxyz(self, x, y, xi, px, py, pz, q, gamma, t):
+        r, sin_t, cos_t = _to_cylindrical(x, y)
+        self.__calculate_wakefields(xi, t)
+        W_r = self._interpolate(self.W_x_data, xi, r)
+        return (W_r*sin_t, W_r*cos_t,
+                self._interpolate(self.E_z_data, xi, r))
 
     def Wz(self, x, y, xi, px, py, pz, q, gamma, t):
-        self.__calculate_wakefields(x, y, xi, px, py, pz, q, gamma, t)
-        R = np.array([xi, np.sqrt(np.square(x)+np.square(y))]).T
-        return self.E_z(R)
+        r = np.hypot(x, y)
+        self.__calculate_wakefields(xi, t)
+        return self._interpolate(self.E_z_data, xi, r)
 
     def Kx(self, x, y, xi, px, py, pz, q, gamma, t):
-        self.__calculate_wakefields(x, y, xi, px, py, pz, q, gamma, t)
-        R = np.array([xi, np.sqrt(np.square(x)+np.square(y))]).T
-        return self.K_x(R)
+        r = np.hypot(x, y)
+        self.__calculate_wakefields(xi, t)
+        return self._interpolate(self.K_x_data, xi, r)
+
+    def _interpolate(self, field_data, xi, r):
+        """ Interpolate the field data at (xi, r). Values outside the grid
+        are 0. """
+        return interp2d_uniform(field_data, *self.grid, xi, r,
+                                np.empty(len(xi)))
 
 
 class PlasmaRampBlowoutField(Wakefield):
-    def __init__(self, density_function):
+    def __init__(self, density_function, z_range=None, n_samples=1024):
+        """
+        If a z_range (z_min, z_max) is given, the density function is
+        sampled at 'n_samples' points in this range and the density of each
+        particle is linearly interpolated from these samples, instead of
+        evaluating the density function for every particle. The range is
+        extended if particles are found outside of it.
+        """
         self.density_function = density_function
+        # k_x = m_e*w_p**2/(2*e*c) = n_p*e/(2*eps_0*c)
+        self._focus_coef = ct.e/(2*ct.epsilon_0*ct.c)
+        self._z_samples = None
+        if z_range is not None:
+            self._sample_density(*z_range, n_samples)
 
     def Wx(self, x, y, xi, px, py, pz, q, gamma, t):
         kx = self.calculate_focusing(xi, t)
@@ -383,18 +530,39 @@ class PlasmaRampBlowoutField(Wakefield):
         kx = self.calculate_focusing(xi, t)
         return ct.c*kx*y
 
+    def Wxy(self, x, y, xi, px, py, pz, q, gamma, t):
+        c_kx = ct.c*self.calculate_focusing(xi, t)
+        return c_kx*x, c_kx*y
+
     def Wz(self, x, y, xi, px, py, pz, q, gamma, t):
-        return np.zeros(len(xi))
+        return np.broadcast_to(0., xi.shape)
 
     def Kx(self, x, y, xi, px, py, pz, q, gamma, t):
         kx = self.calculate_focusing(xi, t)
-        return np.ones(len(xi))*kx
+        return np.broadcast_to(kx, xi.shape)
 
     def calculate_focusing(self, xi, t):
         z = t*ct.c + xi # z postion of each particle at time t
-        n_p = self.density_function(z)
-        w_p = np.sqrt(n_p*ct.e**2/(ct.m_e*ct.epsilon_0))
-        return (ct.m_e/(2*ct.e*ct.c))*w_p**2
+        return self._focus_coef*self._get_density(z)
+
+    def _get_density(self, z):
+        if self._z_samples is None:
+            return self.density_function(z)
+        if z.size == 0:
+            return np.interp(z, self._z_samples, self._n_p_samples)
+        z_min, z_max = _min_max(z)
+        if z_min < self._z_samples[0] or z_max > self._z_samples[-1]:
+            # extend the sampled range keeping the same resolution
+            dz = self._z_samples[1] - self._z_samples[0]
+            z_min = min(z_min, self._z_samples[0])
+            z_max = max(z_max, self._z_samples[-1])
+            self._sample_density(z_min, z_max,
+                                 int(np.ceil((z_max - z_min)/dz)) + 1)
+        return np.interp(z, self._z_samples, self._n_p_samples)
+
+    def _sample_density(self, z_min, z_max, n_samples):
+        self._z_samples = np.linspace(z_min, z_max, n_samples)
+        self._n_p_samples = self.density_function(self._z_samples)
 
 
 class PlasmaLensField(Wakefield):
@@ -414,7 +582,10 @@ class PlasmaLensField(Wakefield):
 
     def Kx(self, x, y, xi, px, py, pz, q, gamma, t):
         # not really important
-        return np.ones(len(x))*self.dB_r
+        return np.broadcast_to(self.dB_r, x.shape)
+
+    def get_kernel(self):
+        return rk4_step_plasma_lens, (float(self.dB_r),)
 
 
 class PlasmaLensFieldRelativistic(Wakefield):
@@ -428,7 +599,154 @@ class PlasmaLensFieldRelativistic(Wakefield):
         return ct.c*self.k_x*y
 
     def Wz(self, x, y, xi, px, py, pz, q, gamma, t):
-        return np.zeros(len(x))
+        return np.broadcast_to(0., x.shape)
 
     def Kx(self, x, y, xi, px, py, pz, q, gamma, t):
-        return np.ones(len(x))*self.k_x
\ No newline at end of file
+        return np.broadcast_to(self.k_x, x.shape)
+
+    def get_kernel(self):
+        return rk4_step_linear_field, (float(self.k_x), 0., 0., 0.)
+
+
+@njit(nogil=True, cache=True)
+def _min_max(a):
+    """ Return the minimum and maximum of a non-empty array in one pass """
+    a_min = a[0]
+    a_max = a[0]
+    for i in range(1, a.shape[0]):
+        if a[i] < a_min:
+            a_min = a[i]
+        elif a[i] > a_max:
+            a_max = a[i]
+    return a_min, a_max
+
+
+def _to_cylindrical(x, y):
+    """
+    Return the radial position r of the particles together with sin(theta)
+    and cos(theta), where theta = arctan2(x, y) (i.e., sin(theta) = x/r and
+    cos(theta) = y/r). Both are 0 on axis, so that the transverse fields
+    of particles on axis vanish.
+    """
+    r = np.hypot(x, y)
+    inv_r = 1/np.where(r == 0, 1., r)
+    return r, x*inv_r, y*inv_r
+
+
+@njit(nogil=True, fastmath=True, cache=True)
+def _calculate_fields_from_potential(u_1, dz, dr, E_z, W_r, K_r):
+    """
+    Calculate the fields E_z = -du_1/dz, W_r = -du_1/dr and K_r = dW_r/dr
+    from the potential 'u_1' in a single pass, as in np.gradient with
+    edge_order=2.
+    """
+    n_z, n_r = u_1.shape
+    for i in range(n_z):
+        if i == 0:
+            for j in range(n_r):
+                E_z[i, j] = -(-3*u_1[0, j] + 4*u_1[1, j] - u_1[2, j])/(2*dz)
+        elif i == n_z - 1:
+            for j in range(n_r):
+                E_z[i, j] = -(3*u_1[-1, j] - 4*u_1[-2, j] + u_1[-3, j])/(2*dz)
+        else:
+            for j in range(n_r):
+                E_z[i, j] = -(u_1[i+1, j] - u_1[i-1, j])/(2*dz)
+        _gradient(u_1[i], dr, W_r[i])
+        for j in range(n_r):
+            W_r[i, j] = -W_r[i, j]
+        _gradient(W_r[i], dr, K_r[i])
+
+
+@njit(fastmath=True, cache=True)
+def _gradient(f, h, out):
+    """ Gradient of the 1D array 'f' as in np.gradient with edge_order=2 """
+    n = f.shape[0]
+    out[0] = (-3*f[0] + 4*f[1] - f[2])/(2*h)
+    for j in range(1, n-1):
+        out[j] = (f[j+1] - f[j-1])/(2*h)
+    out[n-1] = (3*f[n-1] - 4*f[n-2] + f[n-3])/(2*h)
+
+
+@njit(nogil=True, fastmath=True, cache=True)
+def _rk4_wakefield_sweep(u_1, u_2, a0_table, dz):
+    """
+    Integrate the cold fluid wakefield equations along xi with a RK4 method,
+    starting from the last row of 'u_1' and 'u_2' and filling the rest
+    backwards. 'a0_table[i, j]' contains the laser a0 at z, z-dz/2 and z-dz
+    for the i-th step at the j-th radial position.
+    """
+    n_iter, n_r, _ = a0_table.shape
+    for j in range(n_r):
+        for i in range(n_iter):
+            u_1[-2-i, j], u_2[-2-i, j] = _rk4_wakefield_step(
+                u_1[-1-i, j], u_2[-1-i, j], a0_table[i, j, 0],
+                a0_table[i, j, 1], a0_table[i, j, 2], dz)
+
+
+@njit(fastmath=True, cache=True)
+def _rk4_wakefield_step(u_1, u_2, a0_0, a0_1, a0_2, dz):
+    """
+    Advance the solution (u_1, u_2) of the cold fluid wakefield equations at
+    a given radial position by one RK4 step, where a0_0, a0_1 and a0_2 are
+    the laser a0 at the beginning, middle and end of the step.
+    """
+    A_0 = dz*u_2
+    A_1 = dz*((1+a0_0**2)/(2*(1+u_1)**2) - 1/2)
+    B_0 = dz*(u_2 + A_1/2)
+    B_1 = dz*((1+a0_1**2)/(2*(1+u_1+A_0/2)**2) - 1/2)
+    C_0 = dz*(u_2 + B_1/2)
+    C_1 = dz*((1+a0_1**2)/(2*(1+u_1+B_0/2)**2) - 1/2)
+    D_0 = dz*(u_2 + C_1)
+    D_1 = dz*((1+a0_2**2)/(2*(1+u_1+C_0)**2) - 1/2)
+    return (u_1 + 1/6*(A_0 + 2*B_0 + 2*C_0 + D_0),
+            u_2 + 1/6*(A_1 + 2*B_1 + 2*C_1 + D_1))
+
+
+if cuda_installed:
+    # device function of '_rk4_wakefield_step' for the CUDA kernel, compiled
+    # lazily together with the kernel
+    _rk4_wakefield_step_cuda = cuda.jit(device=True)(
+        _rk4_wakefield_step.py_func)
+
+
+def _rk4_wakefield_sweep_on_gpu(u_1, u_2, a0_table, dz):
+    """
+    Same as '_rk4_wakefield_sweep', but running on a CUDA GPU with one
+    thread per radial position. The arrays are copied to the device and
+    the solution is copied back into 'u_1' and 'u_2'.
+    """
+    d_u_1 = cuda.to_device(u_1)
+    d_u_2 = cuda.to_device(u_2)
+    d_a0_table = cuda.to_device(a0_table)
+    threads_per_block = 128
+    n_blocks = (u_1.shape[1] + threads_per_block - 1) // threads_per_block
+    _get_rk4_wakefield_sweep_cuda()[n_blocks, threads_per_block](
+        d_u_1, d_u_2, d_a0_table, dz)
+    d_u_1.copy_to_host(u_1)
+    d_u_2.copy_to_host(u_2)
+
+
+def _is_cuda_available():
+    """ Check whether numba.cuda is installed and finds a GPU """
+    return cuda_installed and cuda.is_available()
+
+
+@lru_cache(maxsize=None)
+def _get_rk4_wakefield_sweep_cuda():
+    """
+    Return the CUDA kernel of '_rk4_wakefield_sweep_on_gpu'. It is compiled
+    on first use, so that CUDA is only initialized when it is requested.
+    """
+    return cuda.jit(_rk4_wakefield_sweep_cuda)
+
+
+def _rk4_wakefield_sweep_cuda(u_1, u_2, a0_table, dz):
+    """ CUDA kernel of '_rk4_wakefield_sweep_on_gpu' (see above) """
+    j = cuda.grid(1)
+    n_iter = a0_table.shape[0]
+    n_z = u_1.shape[0]
+    if j < u_1.shape[1]:
+        for i in range(n_iter):
+            u_1[n_z-2-i, j], u_2[n_z-2-i, j] = _rk4_wakefield_step_cuda(
+                u_1[n_z-1-i, j], u_2[n_z-1-i, j], a0_table[i, j, 0],
+                a0_table[i, j, 1], a0_table[i, j, 2], dz)